@@ -1,27 +1,246 @@
-from fastapi import FastAPI, APIRouter, HTTPException, status
+from fastapi import FastAPI, APIRouter, HTTPException, status, Depends, Header, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
+from fastapi.encoders import decimal_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse, FileResponse, Response
+from starlette.datastructures import Headers
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, GEOSPHERE, IndexModel, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
+from bson import ObjectId, Decimal128
+from bson.errors import InvalidId
+from cryptography.fernet import Fernet, InvalidToken
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from typing import List, Optional, Literal, Union, Annotated
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import random
 import bcrypt
+from PIL import Image, ImageOps
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+import time
+import base64
+import io
+import json
+import re
+import hashlib
+import hmac
+import secrets
+import csv
+import bisect
+import math
+import orjson
+import threading
+import sys
+import traceback
+from pymongo import monitoring
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ========================
+# Metrics
+# ========================
+
+# Latency buckets (seconds) for HTTP requests, Mongo commands and bcrypt jobs
+HTTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MONGO_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PASSWORD_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# How often the event-loop probe wakes up to measure how late it was scheduled
+LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get('LOOP_LAG_INTERVAL_SECONDS', '0.5'))
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    # Monotonic count per label tuple, rendered in the Prometheus text format
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = list(self._values.items())
+        for labels, value in snapshot:
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    # Fixed buckets per label tuple; an observation is a bisect and two additions.
+    # Pymongo calls the command listener from its own threads, hence the lock.
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        names = self.label_names + ("le",)
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+def gauge_lines(name: str, help_text: str, value: float) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests by method, route template and status code.",
+    ("method", "route", "status")
+)
+http_latency = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by method and route template.",
+    ("method", "route"), HTTP_LATENCY_BUCKETS
+)
+mongo_latency = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round-trip time by collection and command.",
+    ("collection", "command"), MONGO_LATENCY_BUCKETS
+)
+mongo_failures = Counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error.",
+    ("collection", "command")
+)
+password_latency = Histogram(
+    "password_job_duration_seconds", "Time bcrypt jobs spend queued and running in the password pool.",
+    ("job",), PASSWORD_LATENCY_BUCKETS
+)
+loop_lag = Histogram(
+    "event_loop_lag_seconds", "How late the event loop ran a timer that was due.",
+    (), LOOP_LAG_BUCKETS
+)
+http_requests_in_flight = 0
+event_loop_lag_last = 0.0
+
+class CommandTimer(monitoring.CommandListener):
+    # The succeeded/failed events carry the duration but not the command, so the
+    # collection is remembered from the started event under its request id
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        self._pending[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        mongo_latency.observe((collection, event.command_name), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        mongo_latency.observe((collection, event.command_name), event.duration_micros / 1e6)
+        mongo_failures.inc((collection, event.command_name))
+
+def route_label(scope) -> str:
+    # The router (or a cache hit) records the matched route in the scope; labelling by
+    # its template rather than the raw path keeps the series count bounded
+    return getattr(scope.get("route"), "path", "unmatched")
+
+class MetricsMiddleware:
+    # Outermost middleware, so cache hits, CORS preflights and error responses are counted too.
+    # Streaming routes (SSE) are timed until the stream closes.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global http_requests_in_flight
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight -= 1
+            route = route_label(scope)
+            http_requests.inc((scope["method"], route, status_code))
+            http_latency.observe((scope["method"], route), time.perf_counter() - started)
+
+async def monitor_loop_lag():
+    # A timer that fires late measures how long other callbacks held the loop
+    global event_loop_lag_last
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        event_loop_lag_last = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL_SECONDS)
+        loop_lag.observe((), event_loop_lag_last)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[CommandTimer()])
 db = client[os.environ['DB_NAME']]
 
+# ========================
+# Response Encoding
+# ========================
+
+def json_default(value):
+    # BSON types Motor hands back that orjson cannot encode itself
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return decimal_encoder(value.to_decimal())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class MongoJSONResponse(ORJSONResponse):
+    # Routes returning Motor documents wrap them in this directly, which skips
+    # FastAPI's jsonable_encoder walk over every field of every item
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=json_default)
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=MongoJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -33,6 +252,142 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Password hashing pool (bcrypt is CPU-bound and must stay off the event loop).
+# "spawn" keeps the workers from inheriting the Motor client's background threads.
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', '32'))
+password_jobs_in_flight = 0
+
+def create_password_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=PASSWORD_HASH_WORKERS,
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+password_executor = create_password_executor()
+
+# OTPs expire after OTP_TTL_SECONDS and lock after OTP_MAX_ATTEMPTS wrong guesses.
+# OTP_BACKEND=memory keeps codes in-process (single node); "mongo" shares them across workers.
+OTP_TTL_SECONDS = int(os.environ.get('OTP_TTL_SECONDS', '600'))
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', '5'))
+OTP_BACKEND = os.environ.get('OTP_BACKEND', 'mongo')
+OTP_CACHE_SIZE = int(os.environ.get('OTP_CACHE_SIZE', '100000'))
+# HMAC key for stored codes; required for the mongo backend, whose hashes outlive the process
+OTP_SECRET = os.environ.get('OTP_SECRET', '')
+
+# Token buckets on the OTP send routes: BURST sends at once, refilled at PER_HOUR.
+# RATE_LIMIT_BACKEND=mongo shares buckets across workers; "memory" keeps them per process.
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+OTP_IP_BURST = int(os.environ.get('OTP_IP_BURST', '10'))
+OTP_IP_PER_HOUR = int(os.environ.get('OTP_IP_PER_HOUR', '60'))
+OTP_IDENTIFIER_BURST = int(os.environ.get('OTP_IDENTIFIER_BURST', '3'))
+OTP_IDENTIFIER_PER_HOUR = int(os.environ.get('OTP_IDENTIFIER_PER_HOUR', '10'))
+# Behind a reverse proxy every client shares the proxy's address; trust its X-Forwarded-For
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', '0') == '1'
+
+# Outbound email/SMS goes through a Mongo outbox drained by background workers.
+# Failed sends retry with exponential backoff; a claimed batch is leased, not owned.
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', '2'))
+DELIVERY_BATCH_SIZE = int(os.environ.get('DELIVERY_BATCH_SIZE', '50'))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get('DELIVERY_MAX_ATTEMPTS', '5'))
+DELIVERY_RETRY_BASE_SECONDS = float(os.environ.get('DELIVERY_RETRY_BASE_SECONDS', '2'))
+DELIVERY_LEASE_SECONDS = int(os.environ.get('DELIVERY_LEASE_SECONDS', '60'))
+DELIVERY_POLL_SECONDS = float(os.environ.get('DELIVERY_POLL_SECONDS', '5'))
+DELIVERY_RETENTION_SECONDS = int(os.environ.get('DELIVERY_RETENTION_SECONDS', str(7 * 24 * 3600)))
+# Payloads (OTP codes among them) are encrypted at rest with a key derived from this secret;
+# it defaults to OTP_SECRET, and one of the two must be set
+OUTBOX_SECRET = os.environ.get('OUTBOX_SECRET', OTP_SECRET)
+# Knobs for the stub provider, to exercise slow and failing sends locally
+DELIVERY_STUB_LATENCY_MS = int(os.environ.get('DELIVERY_STUB_LATENCY_MS', '0'))
+DELIVERY_STUB_FAILURE_RATE = float(os.environ.get('DELIVERY_STUB_FAILURE_RATE', '0'))
+
+# New notifications are pushed to connected SSE/WebSocket clients. With several workers,
+# NOTIFICATION_CHANGE_STREAM=1 feeds every process from a Mongo change stream (replica set only).
+NOTIFICATION_CHANGE_STREAM = os.environ.get('NOTIFICATION_CHANGE_STREAM', '0') == '1'
+NOTIFICATION_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_QUEUE_SIZE', '100'))
+NOTIFICATION_HEARTBEAT_SECONDS = int(os.environ.get('NOTIFICATION_HEARTBEAT_SECONDS', '25'))
+NOTIFICATION_REPLAY_LIMIT = 200
+# Browsers cannot set headers on EventSource, so streams take a one-time ticket from
+# POST /api/notifications/stream-ticket (WebSockets may also send the token as a subprotocol).
+# STREAM_QUERY_TOKEN=1 additionally accepts the session token as ?token=, which then lands
+# in access and proxy logs; only enable it for clients that cannot fetch a ticket.
+STREAM_TICKET_TTL_SECONDS = int(os.environ.get('STREAM_TICKET_TTL_SECONDS', '30'))
+STREAM_QUERY_TOKEN = os.environ.get('STREAM_QUERY_TOKEN', '0') == '1'
+
+# Sessions live in Mongo for SESSION_TTL_SECONDS; hot tokens are cached in-process.
+# The cache TTL bounds how long a logout on another worker can go unnoticed.
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(30 * 24 * 3600)))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL_SECONDS = int(os.environ.get('SESSION_CACHE_TTL_SECONDS', '60'))
+
+# Back-office routes (/api/admin/*) require this shared token in X-Admin-Token; unset disables them
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Per-owner inventory status results are cached briefly and dropped on any status change
+INVENTORY_CACHE_SIZE = int(os.environ.get('INVENTORY_CACHE_SIZE', '5000'))
+INVENTORY_CACHE_TTL_SECONDS = int(os.environ.get('INVENTORY_CACHE_TTL_SECONDS', '30'))
+
+# Per-equipment booking interval indexes kept in memory for availability lookups
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('AVAILABILITY_CACHE_SIZE', '10000'))
+AVAILABILITY_CACHE_TTL_SECONDS = int(os.environ.get('AVAILABILITY_CACHE_TTL_SECONDS', '60'))
+
+# Rendered GET responses kept in memory and served until a write bumps their collections.
+# Writes on other workers are not seen, so the TTL bounds staleness across processes.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '30'))
+
+# Opt-in profiling, also switchable at runtime via PATCH /api/admin/profiling. A watchdog
+# thread logs the loop's stack when it stalls past PROFILE_STALL_MS, and a sampled share of
+# requests is stack-sampled, keeping captures of those slower than PROFILE_SLOW_REQUEST_MS.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+PROFILE_STALL_MS = int(os.environ.get('PROFILE_STALL_MS', '100'))
+PROFILE_SLOW_REQUEST_MS = int(os.environ.get('PROFILE_SLOW_REQUEST_MS', '500'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_SAMPLE_INTERVAL_MS = int(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', ROOT_DIR / 'profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
+# Keyset pagination page sizes for list endpoints
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Documents fetched per Mongo batch (and flushed per chunk) by the NDJSON exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+
+# Recent bookings and notifications bundled into GET /api/me (the rest via their cursors)
+ME_RECENT_LIMIT = 10
+
+# Deepest offset /api/search will page to; refine the query instead of paging further
+SEARCH_MAX_OFFSET = 1000
+
+# Offline geocoding table (city -> [lat, lng]) bundled with the backend
+with open(ROOT_DIR / 'cities.json') as cities_file:
+    CITY_COORDINATES = json.load(cities_file)
+NEARBY_DEFAULT_RADIUS_KM = 25
+NEARBY_MAX_RADIUS_KM = 500
+
+# Compare-and-set attempts for a profile save racing other saves of the same profile
+PROFILE_WRITE_RETRIES = 3
+
+# Rows written per insert_many by the bulk equipment import
+BULK_INSERT_CHUNK_SIZE = int(os.environ.get('BULK_INSERT_CHUNK_SIZE', '500'))
+
+# Inline data-URI images are moved into a content-addressed store on disk
+MEDIA_DIR = Path(os.environ.get('MEDIA_DIR', ROOT_DIR / 'media'))
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', str(10 * 1024 * 1024)))
+
+# Resized variants (longest edge in px; None keeps the original size) built per image
+MEDIA_VARIANTS = {"thumb": 320, "medium": 1024, "full": None}
+MEDIA_VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+MEDIA_VARIANT_QUALITY = int(os.environ.get('MEDIA_VARIANT_QUALITY', '80'))
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', '2'))
+media_executor = ProcessPoolExecutor(
+    max_workers=MEDIA_WORKERS,
+    mp_context=multiprocessing.get_context('spawn')
+)
+media_jobs = set()
+
 # ========================
 # Models
 # ========================
@@ -58,52 +413,1574 @@ class SignupRequest(BaseModel):
     referenceId: Optional[str] = None
     otp: str
 
-class LoginRequest(BaseModel):
-    identifier: str  # email or phone
-    password: Optional[str] = None
-    otp: Optional[str] = None
-    type: str  # 'email' or 'phone'
+class LoginRequest(BaseModel):
+    identifier: str  # email or phone
+    password: Optional[str] = None
+    otp: Optional[str] = None
+    type: str  # 'email' or 'phone'
+
+class SendOtpRequest(BaseModel):
+    identifier: str
+    type: str  # 'email' or 'phone'
+
+class SendSignupOtpRequest(BaseModel):
+    email: EmailStr
+    phone: str
+
+class InitialProfileRequest(BaseModel):
+    userId: str
+    profileType: List[str]
+    freelancerServices: Optional[List[str]] = []
+    businessServices: Optional[List[str]] = []
+
+class EquipmentStatusUpdate(BaseModel):
+    status: Literal["in", "out", "maintenance"]
+
+class BookingStatusUpdate(BaseModel):
+    status: Literal["pending", "confirmed", "in-progress", "completed", "cancelled"]
+
+# Size limits for profile, equipment and booking payloads. Media fields still hold
+# data URIs at validation time, so they are capped at the base64 size of MEDIA_MAX_BYTES.
+MEDIA_REF_MAX_LENGTH = MEDIA_MAX_BYTES * 4 // 3 + 256
+Label = Annotated[str, Field(max_length=100)]
+Link = Annotated[str, Field(max_length=2048)]
+MediaRef = Annotated[str, Field(max_length=MEDIA_REF_MAX_LENGTH)]
+Price = Union[float, Annotated[str, Field(max_length=20)]]
+
+class HourlyPricing(BaseModel):
+    sixHours: Optional[Price] = None
+    eightHours: Optional[Price] = None
+    twelveHours: Optional[Price] = None
+    twentyFourHours: Optional[Price] = None
+
+class AlbumDesignerPricing(BaseModel):
+    perPic: Optional[Price] = None
+    perPage: Optional[Price] = None
+
+class VideoEditorPricing(BaseModel):
+    perMinute: Optional[Price] = None
+    perHour: Optional[Price] = None
+
+class PhotographyFirmPricing(BaseModel):
+    perEvent: Optional[Price] = None
+    perAlbum: Optional[Price] = None
+    perVideo: Optional[Price] = None
+
+class EquipmentItem(BaseModel):
+    equipmentName: Optional[str] = Field(None, max_length=200)
+    category: str = Field(..., min_length=1, max_length=50)
+    brand: str = Field(..., min_length=1, max_length=100)
+    model: str = Field(..., min_length=1, max_length=100)
+    serviceNumber: Optional[str] = Field(None, max_length=100)
+    status: Literal["in", "out", "maintenance"] = "in"
+    pricing: Optional[HourlyPricing] = None
+    images: List[MediaRef] = Field(default_factory=list, max_length=10)
+
+class RentalEquipmentItem(EquipmentItem):
+    id: Optional[str] = Field(None, max_length=100)
+
+class PhotographerEquipment(BaseModel):
+    id: Optional[str] = Field(None, max_length=100)
+    type: Optional[str] = Field(None, max_length=50)
+    name: Optional[str] = Field(None, max_length=200)
+    model: Optional[str] = Field(None, max_length=100)
+    serviceNumber: Optional[str] = Field(None, max_length=100)
+
+# Fields shared by every service profile; unknown fields are dropped on validation
+class ServiceProfileRequest(BaseModel):
+    version: Optional[int] = Field(None, ge=0)  # the version the client loaded; stale saves get 409
+    city: Optional[str] = Field(None, max_length=100)
+    location: Optional[str] = Field(None, max_length=200)
+    lat: Optional[float] = Field(None, ge=-90, le=90)
+    lng: Optional[float] = Field(None, ge=-180, le=180)
+
+class PhotographerProfileRequest(ServiceProfileRequest):
+    yearsOfExperience: Optional[int] = Field(None, ge=0, le=100)
+    styles: List[Label] = Field(default_factory=list, max_length=20)
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    equipment: List[PhotographerEquipment] = Field(default_factory=list, max_length=100)
+    pricing: Optional[HourlyPricing] = None
+
+class CameraRentalProfileRequest(ServiceProfileRequest):
+    equipment: List[RentalEquipmentItem] = Field(default_factory=list, max_length=500)
+
+class AlbumDesignerProfileRequest(ServiceProfileRequest):
+    yearsOfExperience: Optional[int] = Field(None, ge=0, le=100)
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    pricing: Optional[AlbumDesignerPricing] = None
+
+class VideoEditorProfileRequest(ServiceProfileRequest):
+    yearsOfExperience: Optional[int] = Field(None, ge=0, le=100)
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    pricing: Optional[VideoEditorPricing] = None
+
+class WebLiveServicesProfileRequest(ServiceProfileRequest):
+    workLinks: List[Link] = Field(default_factory=list, max_length=10)
+    serviceQualities: List[Label] = Field(default_factory=list, max_length=20)
+    pricing: Optional[HourlyPricing] = None
+
+class LedWallProfileRequest(ServiceProfileRequest):
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    ledTypes: List[Label] = Field(default_factory=list, max_length=20)
+    pricing: Optional[HourlyPricing] = None
+
+class FlyCamProfileRequest(ServiceProfileRequest):
+    yearsOfExperience: Optional[int] = Field(None, ge=0, le=100)
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    serviceQualities: List[Label] = Field(default_factory=list, max_length=20)
+    pricing: Optional[HourlyPricing] = None
+
+class PhotographyFirmProfileRequest(ServiceProfileRequest):
+    yearsOfExperience: Optional[int] = Field(None, ge=0, le=100)
+    workSamples: List[MediaRef] = Field(default_factory=list, max_length=10)
+    serviceTypes: List[Label] = Field(default_factory=list, max_length=20)
+    pricing: Optional[PhotographyFirmPricing] = None
+
+class BookingRequest(BaseModel):
+    equipmentId: Optional[str] = Field(None, max_length=100)
+    providerId: Optional[str] = Field(None, max_length=100)
+    serviceType: Optional[str] = Field(None, max_length=50)
+    startDate: Optional[str] = Field(None, max_length=40)
+    endDate: Optional[str] = Field(None, max_length=40)
+    location: Optional[str] = Field(None, max_length=200)
+    notes: Optional[str] = Field(None, max_length=2000)
+    amount: Optional[float] = Field(None, ge=0)
+
+class MarkReadRequest(BaseModel):
+    notificationId: Optional[str] = Field(None, max_length=100)
+    notificationIds: List[Annotated[str, Field(max_length=100)]] = Field(default_factory=list, max_length=500)
+    before: Optional[datetime] = None  # mark everything created at or before this instant
+
+class ProfilingSettingsUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    stallMs: Optional[int] = Field(None, ge=10, le=60000)
+    slowRequestMs: Optional[int] = Field(None, ge=1, le=600000)
+    sampleRate: Optional[float] = Field(None, ge=0, le=1)
+
+# ========================
+# Database Indexes
+# ========================
+
+# Every index the queries below rely on, keyed by collection
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("phone", ASCENDING)], name="phone_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "sessions": [
+        IndexModel([("token", ASCENDING)], name="token_unique", unique=True),
+        IndexModel([("userId", ASCENDING)], name="userId"),
+        IndexModel([("expiresAt", ASCENDING)], name="expiresAt_ttl", expireAfterSeconds=0),
+    ],
+    "stream_tickets": [
+        IndexModel([("ticket", ASCENDING)], name="ticket_unique", unique=True),
+        IndexModel([("expiresAt", ASCENDING)], name="expiresAt_ttl", expireAfterSeconds=0),
+    ],
+    "otps": [
+        IndexModel([("identifier", ASCENDING)], name="identifier_unique", unique=True),
+        IndexModel([("createdAt", ASCENDING)], name="createdAt_ttl", expireAfterSeconds=OTP_TTL_SECONDS),
+    ],
+    "outbox": [
+        IndexModel([("channel", ASCENDING), ("status", ASCENDING), ("nextAttemptAt", ASCENDING)],
+                   name="channel_status_nextAttemptAt"),
+        IndexModel([("lockId", ASCENDING)], name="lockId", sparse=True),
+        IndexModel([("expiresAt", ASCENDING)], name="expiresAt_ttl", expireAfterSeconds=0),
+    ],
+    "rate_limits": [
+        IndexModel([("expiresAt", ASCENDING)], name="expiresAt_ttl", expireAfterSeconds=0),
+    ],
+    "profiles": [
+        IndexModel([("userId", ASCENDING)], name="userId_unique", unique=True),
+    ],
+    "service_profiles": [
+        IndexModel([("userId", ASCENDING), ("serviceType", ASCENDING)], name="userId_serviceType_unique", unique=True),
+        IndexModel([("search.name", TEXT), ("search.brands", TEXT), ("search.models", TEXT)],
+                   name="search_text", default_language="none",
+                   weights={"search.name": 10, "search.brands": 5, "search.models": 5}),
+        IndexModel([("serviceType", ASCENDING), ("search.city", ASCENDING), ("search.minPrice", ASCENDING)],
+                   name="serviceType_city_minPrice"),
+        IndexModel([("search.city", ASCENDING), ("search.minPrice", ASCENDING)], name="city_minPrice"),
+        IndexModel([("search.categories", ASCENDING), ("search.minPrice", ASCENDING)],
+                   name="categories_minPrice"),
+        IndexModel([("search.geo", GEOSPHERE), ("serviceType", ASCENDING)], name="geo_serviceType"),
+        # Newest-first browsing: the default sort when there is no text query
+        IndexModel([("createdAt", DESCENDING), ("_id", DESCENDING)], name="createdAt_id"),
+        IndexModel([("serviceType", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="serviceType_createdAt_id"),
+    ],
+    "equipment": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("createdAt", DESCENDING), ("_id", DESCENDING)], name="createdAt_id"),
+        IndexModel([("ownerId", ASCENDING), ("createdAt", ASCENDING)], name="ownerId_createdAt"),
+    ],
+    "bookings": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("equipmentId", ASCENDING), ("status", ASCENDING)], name="equipmentId_status"),
+        IndexModel([("equipmentId", ASCENDING), ("startAt", ASCENDING), ("endAt", ASCENDING)],
+                   name="equipmentId_startAt_endAt"),
+        IndexModel([("userId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="userId_createdAt_id"),
+        IndexModel([("ownerId", ASCENDING)], name="ownerId"),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("userId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="userId_createdAt_id"),
+        # Unread counts are answered from this index alone, without fetching documents
+        IndexModel([("userId", ASCENDING), ("read", ASCENDING)], name="userId_read"),
+    ],
+}
+
+# Representative query shapes issued by the routes, used for the plan report
+QUERY_SHAPES = [
+    {"name": "users by email", "collection": "users", "filter": {"email": ""}},
+    {"name": "users by phone", "collection": "users", "filter": {"phone": ""}},
+    {"name": "users by id", "collection": "users", "filter": {"id": ""}},
+    {"name": "sessions by token", "collection": "sessions", "filter": {"token": ""}},
+    {"name": "stream tickets by ticket", "collection": "stream_tickets", "filter": {"ticket": ""}},
+    {"name": "otps by identifier", "collection": "otps", "filter": {"identifier": ""}},
+    {"name": "profiles by userId", "collection": "profiles", "filter": {"userId": ""}},
+    {"name": "search by serviceType and city", "collection": "service_profiles",
+     "filter": {"serviceType": "", "search.city": "", "search.minPrice": {"$lte": 0}},
+     "sort": [("search.minPrice", ASCENDING)]},
+    {"name": "search by equipment category", "collection": "service_profiles",
+     "filter": {"search.categories": ""}, "sort": [("search.minPrice", ASCENDING)]},
+    {"name": "search full text", "collection": "service_profiles", "filter": {"$text": {"$search": "canon"}}},
+    {"name": "search newest", "collection": "service_profiles", "filter": {},
+     "sort": [("createdAt", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "search newest by serviceType", "collection": "service_profiles", "filter": {"serviceType": ""},
+     "sort": [("createdAt", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "equipment page", "collection": "equipment", "filter": {"ownerId": ""},
+     "sort": [("createdAt", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "equipment by ownerId", "collection": "equipment", "filter": {"ownerId": ""},
+     "sort": [("createdAt", ASCENDING)]},
+    {"name": "booking overlaps by equipmentId", "collection": "bookings",
+     "filter": {"equipmentId": "", "startAt": {"$lt": datetime(2000, 1, 2)}, "endAt": {"$gt": datetime(2000, 1, 1)}}},
+    {"name": "active bookings by equipmentId", "collection": "bookings",
+     "filter": {"equipmentId": "", "status": "in-progress"}},
+    {"name": "bookings by userId", "collection": "bookings", "filter": {"userId": ""},
+     "sort": [("createdAt", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "bookings by userId or ownerId", "collection": "bookings",
+     "filter": {"$or": [{"userId": ""}, {"ownerId": ""}]}},
+    {"name": "notifications by userId", "collection": "notifications", "filter": {"userId": ""},
+     "sort": [("createdAt", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "notifications by id", "collection": "notifications", "filter": {"id": ""}},
+    {"name": "unread notifications by userId", "collection": "notifications",
+     "filter": {"userId": "", "read": {"$ne": True}}},
+    {"name": "due outbox messages", "collection": "outbox",
+     "filter": {"channel": "email", "status": "pending", "nextAttemptAt": {"$lte": datetime(1970, 1, 1)}},
+     "sort": [("nextAttemptAt", ASCENDING)]},
+]
+
+# One document per key; older builds inserted a fresh copy on every save. The unique
+# indexes above replace these non-unique ones on the same keys.
+PROFILE_KEYS = {
+    "profiles": {"keys": ["userId"], "legacyIndex": "userId"},
+    "service_profiles": {"keys": ["userId", "serviceType"], "legacyIndex": "userId_serviceType"},
+}
+
+async def collapse_duplicate_profiles():
+    # Keeps the newest document per key so the unique indexes can build; a no-op once they exist
+    for collection, spec in PROFILE_KEYS.items():
+        try:
+            indexes = await db[collection].index_information()
+            if any(info.get("unique") and [key for key, _ in info["key"]] == spec["keys"] for info in indexes.values()):
+                continue
+            groups = db[collection].aggregate([
+                {"$sort": {"createdAt": DESCENDING, "_id": DESCENDING}},
+                {"$group": {
+                    "_id": {key: f"${key}" for key in spec["keys"]},
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}
+                }},
+                {"$match": {"count": {"$gt": 1}}}
+            ], allowDiskUse=True)
+            removed = 0
+            async for group in groups:
+                result = await db[collection].delete_many({"_id": {"$in": group["ids"][1:]}})
+                removed += result.deleted_count
+            if spec["legacyIndex"] in indexes:
+                await db[collection].drop_index(spec["legacyIndex"])
+            logger.info(f"Collapsed {removed} duplicate documents in {collection}")
+        except OperationFailure as e:
+            logger.error(f"Failed to collapse duplicates in {collection}: {e}")
+
+async def ensure_indexes():
+    # create_indexes is a no-op for indexes that already exist with the same spec
+    for collection, indexes in INDEXES.items():
+        try:
+            created = await db[collection].create_indexes(indexes)
+            logger.info(f"Indexes ready on {collection}: {', '.join(created)}")
+        except OperationFailure as e:
+            # e.g. duplicate data blocking a unique index; keep serving and surface it in the logs
+            logger.error(f"Failed to build indexes on {collection}: {e}")
+
+def summarize_plan(plan: dict) -> dict:
+    stages = []
+    index_names = []
+    while plan:
+        stages.append(plan.get("stage"))
+        if plan.get("indexName"):
+            index_names.append(plan["indexName"])
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return {"stages": stages, "indexes": index_names, "collectionScan": "COLLSCAN" in stages}
+
+async def explain_query_shapes() -> List[dict]:
+    report = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        try:
+            explain = await cursor.explain()
+        except OperationFailure as e:
+            # e.g. the text index is missing; report the shape instead of failing the whole report
+            report.append({
+                "query": shape["name"],
+                "collection": shape["collection"],
+                "error": str(e),
+                "collectionScan": False
+            })
+            continue
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        report.append({
+            "query": shape["name"],
+            "collection": shape["collection"],
+            **summarize_plan(winning_plan.get("queryPlan", winning_plan))
+        })
+    return report
+
+# ========================
+# Helper Functions
+# ========================
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+# Run a bcrypt helper in the password pool, shedding load with 503 when saturated
+async def run_password_job(func, *args):
+    global password_jobs_in_flight, password_executor
+    if password_jobs_in_flight >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    password_jobs_in_flight += 1
+    executor = password_executor
+    started = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); replace the pool so later requests recover
+        if password_executor is executor:
+            logger.error("Password hashing pool broken, restarting workers")
+            password_executor = create_password_executor()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    finally:
+        password_jobs_in_flight -= 1
+        password_latency.observe((func.__name__,), time.perf_counter() - started)
+
+# Bounded LRU cache whose entries also expire after a TTL
+class TTLCache:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._entries)
+
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL_SECONDS)
+inventory_status_cache = TTLCache(INVENTORY_CACHE_SIZE, INVENTORY_CACHE_TTL_SECONDS)
+availability_cache = TTLCache(AVAILABILITY_CACHE_SIZE, AVAILABILITY_CACHE_TTL_SECONDS)
+
+def generate_otp() -> str:
+    return "123456"  # Fixed OTP for testing
+
+def generate_token() -> str:
+    return str(uuid.uuid4())
+
+async def revoke_user_sessions(user_id: str):
+    old_sessions = await db.sessions.find({"userId": user_id}, {"_id": 0, "token": 1}).to_list(None)
+    for session in old_sessions:
+        session_cache.pop(session["token"])
+    await db.sessions.delete_many({"userId": user_id})
+
+async def create_session(user_id: str) -> str:
+    # Each login gets its own session, so signing in on one device keeps the others;
+    # /auth/logout ends this one and /auth/logout-all every session of the user
+    token = generate_token()
+    now = datetime.utcnow()
+    await db.sessions.insert_one({
+        "token": token,
+        "userId": user_id,
+        "createdAt": now,
+        "expiresAt": now + timedelta(seconds=SESSION_TTL_SECONDS)
+    })
+    return token
+
+# ========================
+# OTP Service
+# ========================
+
+# A leaked key lets anyone with the database brute-force the 10^6 codes, so there is no
+# built-in default. Memory-held codes die with the process and can use a key that does too.
+if OTP_SECRET:
+    otp_key = OTP_SECRET.encode('utf-8')
+elif OTP_BACKEND == "memory":
+    otp_key = secrets.token_bytes(32)
+else:
+    raise RuntimeError("OTP_SECRET must be set when OTP_BACKEND=mongo")
+
+def hash_otp(identifier: str, otp: str) -> str:
+    # Keyed with the identifier so the same code never hashes the same for two users
+    message = f"{identifier}:{otp}".encode('utf-8')
+    return hmac.new(otp_key, message, hashlib.sha256).hexdigest()
+
+def otp_locked() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many OTP attempts, request a new code"
+    )
+
+class MemoryOtpStore:
+    # Single-node store; codes never leave the process and expire with the cache entry
+    def __init__(self):
+        self._codes = TTLCache(OTP_CACHE_SIZE, OTP_TTL_SECONDS)
+
+    async def issue(self, identifier: str, otp: str, **fields):
+        self._codes.set(identifier, {**fields, "otpHash": hash_otp(identifier, otp), "attempts": 0})
+
+    async def verify(self, identifier: str, otp: str) -> Optional[dict]:
+        record = self._codes.get(identifier)
+        if record is None:
+            return None
+        if record["attempts"] >= OTP_MAX_ATTEMPTS:
+            raise otp_locked()
+        if hmac.compare_digest(record["otpHash"], hash_otp(identifier, otp)):
+            self._codes.pop(identifier)
+            return record
+        record["attempts"] += 1
+        return None
+
+class MongoOtpStore:
+    # Shared store; the TTL monitor only sweeps once a minute, so expiry is also checked on read
+    async def issue(self, identifier: str, otp: str, **fields):
+        await db.otps.update_one(
+            {"identifier": identifier},
+            {"$set": {
+                **fields,
+                "otpHash": hash_otp(identifier, otp),
+                "attempts": 0,
+                "createdAt": datetime.utcnow()
+            }},
+            upsert=True
+        )
+
+    async def verify(self, identifier: str, otp: str) -> Optional[dict]:
+        # A correct code is matched and consumed in one round trip. The comparison is on
+        # the HMAC inside Mongo, so response timing reveals nothing about the code itself.
+        live = {"identifier": identifier, "createdAt": {"$gt": datetime.utcnow() - timedelta(seconds=OTP_TTL_SECONDS)}}
+        record = await db.otps.find_one_and_delete(
+            {**live, "otpHash": hash_otp(identifier, otp), "attempts": {"$lt": OTP_MAX_ATTEMPTS}},
+            projection={"_id": 0}
+        )
+        if record:
+            return record
+        failed = await db.otps.find_one_and_update(
+            live,
+            {"$inc": {"attempts": 1}},
+            projection={"_id": 0, "attempts": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if failed and failed["attempts"] >= OTP_MAX_ATTEMPTS:
+            raise otp_locked()
+        return None
+
+otp_store = MemoryOtpStore() if OTP_BACKEND == "memory" else MongoOtpStore()
+
+# ========================
+# Rate Limiting
+# ========================
+
+class MemoryTokenBucket:
+    # Per-process buckets; the least recently used keys are dropped past max_keys
+    def __init__(self, burst: int, per_hour: int):
+        self.burst = burst
+        self.rate = per_hour / 3600
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until one is available
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > RATE_LIMIT_MAX_KEYS:
+            self._buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / self.rate
+
+class MongoTokenBucket:
+    # Shared buckets, refilled and spent in a single pipeline update so concurrent
+    # workers never double-spend; a bucket expires once it would be full again
+    def __init__(self, burst: int, per_hour: int):
+        self.burst = burst
+        self.rate = per_hour / 3600
+
+    async def take(self, key: str) -> float:
+        now = datetime.utcnow()
+        refilled = {"$min": [self.burst, {"$add": [
+            {"$ifNull": ["$tokens", self.burst]},
+            {"$multiply": [{"$divide": [{"$subtract": [now, {"$ifNull": ["$updatedAt", now]}]}, 1000]}, self.rate]}
+        ]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updatedAt": now}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "expiresAt": now + timedelta(seconds=self.burst / self.rate)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if bucket["allowed"] else (1 - bucket["tokens"]) / self.rate
+
+def create_token_bucket(burst: int, per_hour: int):
+    if RATE_LIMIT_BACKEND == "mongo":
+        return MongoTokenBucket(burst, per_hour)
+    return MemoryTokenBucket(burst, per_hour)
+
+otp_ip_buckets = create_token_bucket(OTP_IP_BURST, OTP_IP_PER_HOUR)
+otp_identifier_buckets = create_token_bucket(OTP_IDENTIFIER_BURST, OTP_IDENTIFIER_PER_HOUR)
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        # The right-most entry is the one our own proxy appended
+        forwarded = request.headers.get("x-forwarded-for", "").split(",")[-1].strip()
+        if forwarded:
+            return forwarded
+    return request.client.host if request.client else "unknown"
+
+async def limit_otp_sends(request: Request, *identifiers: str):
+    # Checked before any DB work; the IP bucket goes first so a flood from one
+    # address cannot drain the buckets of the identifiers it is cycling through
+    retry_after = await otp_ip_buckets.take(f"otp:ip:{client_ip(request)}")
+    for identifier in identifiers:
+        if retry_after:
+            break
+        retry_after = await otp_identifier_buckets.take(f"otp:id:{identifier.strip().lower()}")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many OTP requests, try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
+# ========================
+# Delivery Queue
+# ========================
+
+DELIVERY_CHANNELS = ("email", "sms")
+delivery_wakeup: Optional[asyncio.Event] = None
+
+# Counters are per process; queue depth comes from the outbox itself
+delivery_stats = {"enqueued": 0, "sent": 0, "retried": 0, "failed": 0}
+delivery_latencies = deque(maxlen=1000)  # seconds from enqueue to provider acceptance
+
+class StubDeliveryProvider:
+    # Stands in for the email and SMS gateways by logging each message
+    async def send_batch(self, channel: str, messages: List[dict]) -> List[Optional[str]]:
+        # One provider call per batch; returns an error (or None) for each message
+        if DELIVERY_STUB_LATENCY_MS:
+            await asyncio.sleep(DELIVERY_STUB_LATENCY_MS / 1000)
+        errors = []
+        for message in messages:
+            if random.random() < DELIVERY_STUB_FAILURE_RATE:
+                errors.append("Stub provider failure")
+                continue
+            logger.info(f"{message['kind']} via {channel} to {message['to']}: {message['payload']}")
+            errors.append(None)
+        return errors
+
+delivery_provider = StubDeliveryProvider()
+
+# Queued payloads outlive the process and are read by every worker, so unlike the
+# memory OTP store there is no per-process fallback key
+if not OUTBOX_SECRET:
+    raise RuntimeError("OUTBOX_SECRET (or OTP_SECRET) must be set to encrypt queued deliveries")
+
+# Fernet takes a urlsafe-base64 32-byte key; the label keeps it distinct from the OTP hash key
+outbox_cipher = Fernet(base64.urlsafe_b64encode(
+    hmac.new(OUTBOX_SECRET.encode('utf-8'), b"outbox-payload", hashlib.sha256).digest()
+))
+
+def seal_payload(payload: dict) -> bytes:
+    return outbox_cipher.encrypt(orjson.dumps(payload))
+
+def open_payload(sealed) -> dict:
+    if isinstance(sealed, dict):
+        return sealed  # enqueued by an older build, before payloads were sealed
+    return orjson.loads(outbox_cipher.decrypt(sealed))
+
+async def enqueue_delivery(channel: str, to: str, kind: str, payload: dict, ttl_seconds: Optional[int] = None):
+    # Persisted before the request returns, so a restart loses nothing. Messages that
+    # are useless after a while (OTPs) pass a ttl and are dropped undelivered once it lapses.
+    now = datetime.utcnow()
+    await db.outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "channel": channel,
+        "to": to,
+        "kind": kind,
+        "payload": seal_payload(payload),
+        "status": "pending",
+        "attempts": 0,
+        "createdAt": now,
+        "nextAttemptAt": now,
+        "expiresAt": now + timedelta(seconds=ttl_seconds or DELIVERY_RETENTION_SECONDS)
+    })
+    delivery_stats["enqueued"] += 1
+    if delivery_wakeup:
+        delivery_wakeup.set()
+
+async def claim_deliveries(channel: str) -> List[dict]:
+    # Claiming pushes nextAttemptAt out by the lease, so a worker that dies mid-batch
+    # only delays its messages; the re-checked filter keeps two workers off one message
+    now = datetime.utcnow()
+    due = {"channel": channel, "status": "pending", "nextAttemptAt": {"$lte": now}, "expiresAt": {"$gt": now}}
+    candidates = await db.outbox.find(due, {"_id": 1}).sort("nextAttemptAt", ASCENDING).limit(
+        DELIVERY_BATCH_SIZE
+    ).to_list(DELIVERY_BATCH_SIZE)
+    if not candidates:
+        return []
+    lock_id = str(uuid.uuid4())
+    await db.outbox.update_many(
+        {**due, "_id": {"$in": [doc["_id"] for doc in candidates]}},
+        {"$set": {"lockId": lock_id, "nextAttemptAt": now + timedelta(seconds=DELIVERY_LEASE_SECONDS)}}
+    )
+    return await db.outbox.find({"lockId": lock_id}).to_list(None)
+
+def delivery_outcome(message: dict, error: Optional[str], now: datetime) -> UpdateOne:
+    attempts = message["attempts"] + 1
+    if error is None:
+        delivery_stats["sent"] += 1
+        delivery_latencies.append((now - message["createdAt"]).total_seconds())
+        update = {"status": "sent", "sentAt": now}
+    elif attempts >= DELIVERY_MAX_ATTEMPTS:
+        delivery_stats["failed"] += 1
+        logger.error(f"Giving up on {message['kind']} via {message['channel']} to {message['to']}: {error}")
+        update = {"status": "failed", "lastError": error}
+    else:
+        # Exponential backoff with jitter so a provider outage does not retry in lockstep
+        delivery_stats["retried"] += 1
+        backoff = DELIVERY_RETRY_BASE_SECONDS * 2 ** message["attempts"] * random.uniform(0.5, 1.5)
+        return UpdateOne(
+            {"_id": message["_id"], "lockId": message["lockId"]},
+            {"$set": {"attempts": attempts, "lastError": error, "nextAttemptAt": now + timedelta(seconds=backoff)},
+             "$unset": {"lockId": ""}}
+        )
+    # Finished messages drop their payload (OTPs included) and are kept for the retention period
+    return UpdateOne(
+        {"_id": message["_id"], "lockId": message["lockId"]},
+        {"$set": {**update, "attempts": attempts, "expiresAt": now + timedelta(seconds=DELIVERY_RETENTION_SECONDS)},
+         "$unset": {"payload": "", "lockId": ""}}
+    )
+
+async def deliver_batch(channel: str) -> int:
+    batch = await claim_deliveries(channel)
+    if not batch:
+        return 0
+    # Payloads are decrypted only for the provider call; the stored copy stays sealed
+    errors = {}
+    sendable = []
+    for message in batch:
+        try:
+            message["payload"] = open_payload(message["payload"])
+            sendable.append(message)
+        except InvalidToken:
+            errors[message["id"]] = "Payload could not be decrypted"
+    if sendable:
+        try:
+            results = await delivery_provider.send_batch(channel, sendable)
+        except Exception as e:
+            results = [str(e)] * len(sendable)
+        errors.update((message["id"], error) for message, error in zip(sendable, results))
+    now = datetime.utcnow()
+    await db.outbox.bulk_write(
+        [delivery_outcome(message, errors.get(message["id"]), now) for message in batch],
+        ordered=False
+    )
+    return len(batch)
+
+async def delivery_worker():
+    # Drains every channel until nothing is due, then sleeps until an enqueue wakes it.
+    # The poll interval picks up retries and messages enqueued by other processes.
+    while True:
+        delivery_wakeup.clear()
+        try:
+            delivered = 0
+            for channel in DELIVERY_CHANNELS:
+                delivered += await deliver_batch(channel)
+            if delivered:
+                continue
+        except Exception as e:
+            logger.error(f"Delivery worker failed: {e}")
+        try:
+            await asyncio.wait_for(delivery_wakeup.wait(), DELIVERY_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# ========================
+# Notification Hub
+# ========================
+
+class NotificationHub:
+    # In-process fan-out of new notifications to their user's open connections
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def publish(self, notification: dict):
+        for queue in list(self._subscribers.get(notification["userId"], ())):
+            try:
+                queue.put_nowait(notification)
+            except asyncio.QueueFull:
+                # A client this far behind is cut loose; it reconnects and replays from Mongo
+                self.unsubscribe(notification["userId"], queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def __len__(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+notification_hub = NotificationHub()
+
+async def create_notification(user_id: str, kind: str, title: str, message: str):
+    now = datetime.utcnow()
+    notification = {
+        "id": str(uuid.uuid4()),
+        "userId": user_id,
+        "type": kind,
+        "title": title,
+        "message": message,
+        "read": False,
+        # Mongo keeps milliseconds; truncating here makes live and replayed event ids identical
+        "createdAt": now.replace(microsecond=now.microsecond // 1000 * 1000)
+    }
+    # insert_one stamps the _id the event id is built from
+    await db.notifications.insert_one(notification)
+    if not NOTIFICATION_CHANGE_STREAM:
+        notification_hub.publish(notification)
+
+async def unread_notifications(user_id: str) -> int:
+    # Counted from the userId_read index on every call, so it cannot drift from the documents
+    return await db.notifications.count_documents({"userId": user_id, "read": {"$ne": True}})
+
+async def watch_notifications():
+    # Every worker hears about every insert, whichever worker made it
+    resume_token = None
+    while True:
+        try:
+            async with db.notifications.watch(
+                [{"$match": {"operationType": "insert"}}],
+                resume_after=resume_token
+            ) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    notification_hub.publish(change["fullDocument"])
+        except Exception as e:
+            logger.error(f"Notification change stream failed: {e}")
+            await asyncio.sleep(5)
+
+def notification_event(doc: dict):
+    fields = READ_FIELDS["notifications"]["default"]
+    return encode_cursor(doc), {name: doc[name] for name in fields if name in doc}
+
+async def notification_events(user_id: str, after: Optional[tuple]):
+    # Replays what was missed after the (createdAt, _id) of Last-Event-ID, then streams
+    # live pushes; yields None on idle heartbeats. Subscribing before the replay query
+    # means nothing created in between is lost, and the position check drops duplicates.
+    queue = notification_hub.subscribe(user_id)
+    try:
+        if after:
+            created_at, last_id = after
+            missed = await db.notifications.find({"userId": user_id, "$or": [
+                {"createdAt": {"$gt": created_at}},
+                {"createdAt": created_at, "_id": {"$gt": last_id}}
+            ]}).sort([("createdAt", ASCENDING), ("_id", ASCENDING)]).limit(
+                NOTIFICATION_REPLAY_LIMIT
+            ).to_list(NOTIFICATION_REPLAY_LIMIT)
+            for doc in missed:
+                after = (doc["createdAt"], doc["_id"])
+                yield notification_event(doc)
+        while True:
+            try:
+                doc = await asyncio.wait_for(queue.get(), NOTIFICATION_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if doc is None:
+                return
+            if after and (doc["createdAt"], doc["_id"]) <= after:
+                continue
+            after = (doc["createdAt"], doc["_id"])
+            yield notification_event(doc)
+    finally:
+        notification_hub.unsubscribe(user_id, queue)
+
+async def sse_lines(events):
+    async for event in events:
+        if event is None:
+            yield b": ping\n\n"
+            continue
+        event_id, notification = event
+        data = orjson.dumps(notification, default=json_default)
+        yield b"id: " + event_id.encode('ascii') + b"\nevent: notification\ndata: " + data + b"\n\n"
+
+# ========================
+# Response Cache
+# ========================
+
+# Read routes served from the cache, with the collections their responses depend on
+CACHED_ROUTES = [
+    (re.compile(r"^/api/profile/[^/]+$"), ("profiles",)),
+    (re.compile(r"^/api/inventory/equipment$"), ("equipment",)),
+    (re.compile(r"^/api/inventory/status$"), ("equipment", "bookings", "users")),
+    (re.compile(r"^/api/bookings/(?!export$)[^/]+$"), ("bookings",)),
+]
+
+# Bumped after every write to a collection; cached responses remember the stamps they were built under
+collection_versions = {"profiles": 0, "equipment": 0, "bookings": 0, "users": 0}
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS)
+response_cache_stats = {"hits": 0, "misses": 0, "notModified": 0}
+
+def mark_changed(*collections: str):
+    for name in collections:
+        collection_versions[name] += 1
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+class ResponseCacheMiddleware:
+    # Serves repeat GETs of the routes above without touching Mongo or re-serializing.
+    # Stamps are read before the handler runs, so a write that lands mid-request
+    # leaves the stored entry already stale rather than wrongly fresh.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        collections = next((deps for pattern, deps in CACHED_ROUTES if pattern.match(scope["path"])), None)
+        if collections is None:
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        if_none_match = headers.get("if-none-match")
+        # Responses may depend on the caller (inventory status), so the token is part of the key
+        authorization = headers.get("authorization")
+        key = (scope["path"], scope["query_string"], authorization)
+        versions = tuple(collection_versions[name] for name in collections)
+        entry = response_cache.get(key)
+        if entry and entry["versions"] == versions and await self.session_valid(authorization):
+            response_cache_stats["hits"] += 1
+            scope["route"] = entry["route"]
+            return await self.respond(entry, if_none_match, scope, receive, send)
+        response_cache_stats["misses"] += 1
+
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            else:
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+        body = b"".join(chunks)
+        if start["status"] != status.HTTP_200_OK:
+            await send(start)
+            return await send({"type": "http.response.body", "body": body})
+
+        entry = {
+            "versions": versions,
+            "body": body,
+            "etag": body_etag(body),
+            "mediaType": Headers(raw=start["headers"]).get("content-type", "application/json"),
+            "route": scope.get("route")
+        }
+        response_cache.set(key, entry)
+        await self.respond(entry, if_none_match, scope, receive, send)
+
+    @staticmethod
+    async def session_valid(authorization: Optional[str]) -> bool:
+        # A hit runs before the route's auth dependency, so re-check that the token still
+        # resolves; after a logout or re-login the request falls through to the handler
+        if authorization is None:
+            return True
+        try:
+            await authenticate(bearer_token(authorization))
+        except HTTPException:
+            return False
+        return True
+
+    async def respond(self, entry: dict, if_none_match: Optional[str], scope, receive, send):
+        headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+        if if_none_match and entry["etag"] in if_none_match:
+            response_cache_stats["notModified"] += 1
+            response = Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        else:
+            response = Response(entry["body"], media_type=entry["mediaType"], headers=headers)
+        await response(scope, receive, send)
+
+# ========================
+# Profiling
+# ========================
+
+profiling_settings = {
+    "enabled": PROFILING_ENABLED,
+    "stallMs": PROFILE_STALL_MS,
+    "slowRequestMs": PROFILE_SLOW_REQUEST_MS,
+    "sampleRate": PROFILE_SAMPLE_RATE
+}
+profiling_stats = {"stalls": 0, "captures": 0}
+recent_stalls = deque(maxlen=20)
+loop_watchdog = None
+active_sampler = None
+
+def fold_stack(frame) -> List[str]:
+    # Outermost call first, as flamegraph.pl and speedscope expect
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+class LoopWatchdog:
+    # Pings the loop from a thread; a ping left unanswered past the threshold means a
+    # callback is holding the loop thread, whose stack is taken while it still does
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()  # created from a handler on the loop thread
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="loop-watchdog", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            threshold = profiling_settings["stallMs"] / 1000
+            answered = threading.Event()
+            try:
+                self.loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                return  # loop closed
+            pinged = time.perf_counter()
+            if answered.wait(threshold):
+                self._stop.wait(threshold)
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            while not answered.wait(1) and not self._stop.is_set():
+                pass
+            stalled_ms = round((time.perf_counter() - pinged) * 1000)
+            profiling_stats["stalls"] += 1
+            recent_stalls.append({"at": datetime.utcnow(), "ms": stalled_ms, "stack": stack})
+            logger.warning("Event loop blocked for %dms; loop thread was at:\n%s", stalled_ms, stack)
+
+class StackSampler:
+    # Samples the loop thread's stack every PROFILE_SAMPLE_INTERVAL_MS while a request runs.
+    # Other requests share the thread, so a capture shows everything that held the loop
+    # meanwhile; samples parked in the selector (waiting on I/O) are counted as idle.
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.stacks = {}
+        self.idle = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            if frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle += 1
+                continue
+            folded = ";".join(fold_stack(frame))
+            self.stacks[folded] = self.stacks.get(folded, 0) + 1
+
+def write_capture(name: str, stacks: dict) -> Path:
+    # Collapsed-stack format ("frame;frame;frame count"), newest PROFILE_KEEP files kept
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / name
+    path.write_text("".join(f"{stack} {count}\n" for stack, count in stacks.items()))
+    captures = sorted(PROFILE_DIR.glob("*.folded"), key=lambda p: p.stat().st_mtime)
+    for old in captures[:-PROFILE_KEEP]:
+        old.unlink(missing_ok=True)
+    return path
+
+# Responses that stream for as long as the client keeps reading; profiling skips them by path
+# because nothing in the request (an Accept header, say) reliably marks them
+STREAMING_PATHS = {"/api/notifications/stream", "/api/inventory/equipment/export", "/api/bookings/export"}
+
+class ProfilingMiddleware:
+    # One sampled request is captured at a time; streams would hold the sampler, so they are skipped
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global active_sampler
+        if (scope["type"] != "http" or not profiling_settings["enabled"] or active_sampler is not None
+                or random.random() >= profiling_settings["sampleRate"]
+                or scope["path"] in STREAMING_PATHS):
+            return await self.app(scope, receive, send)
+
+        sampler = active_sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            sampler.stop()
+            active_sampler = None
+            elapsed_ms = round((time.perf_counter() - started) * 1000)
+            if elapsed_ms >= profiling_settings["slowRequestMs"] and sampler.stacks:
+                route = re.sub(r"[^A-Za-z0-9]+", "_", route_label(scope)).strip("_")
+                name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{scope['method']}-{route}-{elapsed_ms}ms.folded"
+                path = await asyncio.to_thread(write_capture, name, dict(sampler.stacks))
+                profiling_stats["captures"] += 1
+                logger.info("Slow request %s %s took %dms (%d idle samples); profile written to %s",
+                            scope["method"], scope["path"], elapsed_ms, sampler.idle, path)
+
+def start_loop_watchdog():
+    global loop_watchdog
+    if loop_watchdog is None:
+        loop_watchdog = LoopWatchdog(asyncio.get_running_loop())
+        loop_watchdog.start()
+
+def stop_loop_watchdog():
+    global loop_watchdog
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+        loop_watchdog = None
+
+# ========================
+# Read Projections
+# ========================
+
+# Fields each read endpoint returns by default, plus the heavier ones ?fields= may opt into.
+# Inline images and work samples stay out of list responses unless asked for.
+READ_FIELDS = {
+    "user": {
+        "default": ["id", "fullName", "email", "phone", "referenceId", "profileCompleted", "userType", "createdAt"],
+        "optional": []
+    },
+    "profile": {
+        "default": ["userId", "profileType", "freelancerServices", "businessServices", "version",
+                    "createdAt", "updatedAt"],
+        "optional": []
+    },
+    "equipment": {
+        "default": ["id", "ownerId", "equipmentName", "category", "brand", "model", "serviceNumber",
+                    "status", "pricing", "createdAt"],
+        "optional": ["images"]
+    },
+    "bookings": {
+        "default": ["id", "userId", "ownerId", "equipmentId", "providerId", "serviceType", "startDate",
+                    "endDate", "location", "notes", "amount", "status", "createdAt"],
+        "optional": ["startAt", "endAt", "updatedAt"]
+    },
+    "notifications": {
+        "default": ["id", "userId", "type", "title", "message", "read", "createdAt"],
+        "optional": []
+    },
+}
+
+# Login only needs the password hash plus the fields it echoes back
+LOGIN_USER_PROJECTION = {
+    "_id": 0, "id": 1, "fullName": 1, "email": 1, "phone": 1,
+    "profileCompleted": 1, "userType": 1, "password": 1
+}
+
+def read_fields(resource: str, fields: Optional[str]) -> List[str]:
+    # ?fields=id,status narrows the response to those fields (sparse fieldset)
+    spec = READ_FIELDS[resource]
+    if not fields:
+        return spec["default"]
+    requested = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in requested if name not in spec["default"] and name not in spec["optional"]]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields requested"
+        )
+    return requested
+
+def read_projection(resource: str, fields: Optional[str]) -> dict:
+    return {"_id": 0, **{name: 1 for name in read_fields(resource, fields)}}
+
+# ========================
+# Pagination
+# ========================
+
+# Cursors are opaque to clients: base64url JSON of the last item's (createdAt, _id)
+def encode_cursor(doc: dict) -> str:
+    payload = json.dumps({"c": doc["createdAt"].isoformat(), "i": str(doc["_id"])})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(payload["c"]), ObjectId(payload["i"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+async def paginate(
+    collection,
+    query: dict,
+    cursor: Optional[str],
+    limit: int,
+    fields: Optional[List[str]] = None
+) -> dict:
+    # Newest first; _id breaks ties between documents created in the same millisecond
+    if cursor:
+        created_at, last_id = decode_cursor(cursor)
+        query = {"$and": [query, {"$or": [
+            {"createdAt": {"$lt": created_at}},
+            {"createdAt": created_at, "_id": {"$lt": last_id}}
+        ]}]}
+
+    # The cursor needs createdAt and _id even when the fieldset leaves them out
+    projection = {**{name: 1 for name in fields}, "createdAt": 1} if fields else None
+    docs = await collection.find(query, projection).sort(
+        [("createdAt", DESCENDING), ("_id", DESCENDING)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    # _id is fetched only to build the cursor and never leaves this function
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1])
+    for doc in docs:
+        doc.pop("_id", None)
+        if fields and "createdAt" not in fields:
+            doc.pop("createdAt", None)
+
+    return {"items": docs, "next_cursor": next_cursor}
+
+async def insert_document(collection, doc: dict):
+    # insert_one stamps _id onto the dict it is given; keep it off documents we return
+    return await collection.insert_one(dict(doc))
+
+# ========================
+# NDJSON Export
+# ========================
+
+async def ndjson_lines(cursor):
+    # One chunk per Mongo batch keeps memory flat without a write per document
+    lines = []
+    async for doc in cursor:
+        lines.append(orjson.dumps(doc, default=json_default))
+        if len(lines) >= EXPORT_BATCH_SIZE:
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+def ndjson_export(collection, query: dict) -> StreamingResponse:
+    cursor = collection.find(query, {"_id": 0}).batch_size(EXPORT_BATCH_SIZE)
+    return StreamingResponse(ndjson_lines(cursor), media_type="application/x-ndjson")
+
+# ========================
+# Media Store
+# ========================
+
+DATA_URI_PATTERN = re.compile(r'^data:(image/[\w.+-]+);base64,', re.IGNORECASE)
+MEDIA_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+MEDIA_URL_PREFIX = "/api/media/"
+
+# Sniffed from the stored bytes so blobs need no metadata alongside them
+MEDIA_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+]
+
+def verify_image(data: bytes):
+    # Only bytes Pillow parses as one of the formats above are stored and served
+    if not any(data.startswith(signature) for signature, _ in MEDIA_SIGNATURES):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unsupported image format"
+        )
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid image"
+        )
+
+def media_path(digest: str) -> Path:
+    return MEDIA_DIR / digest[:2] / digest
+
+def store_blob(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = media_path(digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so concurrent uploads of the same image never expose a partial file
+        tmp_path = path.with_name(f"{digest}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    return digest
+
+def media_variant_path(digest: str, variant: str, fmt: str) -> Path:
+    return MEDIA_DIR / digest[:2] / f"{digest}.{variant}.{fmt}"
+
+def generate_variants(digest: str) -> List[str]:
+    # Runs in the media pool: decode once, then encode every missing size/format pair.
+    # Re-saves of deduplicated images find every variant on disk and skip the decode.
+    missing = {
+        variant: [fmt for fmt in MEDIA_VARIANT_FORMATS if not media_variant_path(digest, variant, fmt).exists()]
+        for variant in MEDIA_VARIANTS
+    }
+    if not any(missing.values()):
+        return []
+
+    with Image.open(media_path(digest)) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+
+    created = []
+    for variant, max_edge in MEDIA_VARIANTS.items():
+        if not missing[variant]:
+            continue
+        resized = image.copy()
+        if max_edge:
+            resized.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        for fmt in missing[variant]:
+            path = media_variant_path(digest, variant, fmt)
+            pil_format = MEDIA_VARIANT_FORMATS[fmt]
+            tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+            resized.save(tmp_path, pil_format, quality=MEDIA_VARIANT_QUALITY, optimize=True)
+            os.replace(tmp_path, path)
+            created.append(path.name)
+    return created
+
+def on_variants_done(digest: str, future):
+    media_jobs.discard(future)
+    if future.exception():
+        logger.error(f"Variant generation failed for {digest}: {future.exception()}")
+
+def schedule_variants(digests):
+    # Fire and forget: the upload response does not wait for resizing
+    for digest in digests:
+        future = media_executor.submit(generate_variants, digest)
+        media_jobs.add(future)
+        future.add_done_callback(lambda f, digest=digest: on_variants_done(digest, f))
+
+def store_data_uri(value: str, stored: List[str]) -> str:
+    match = DATA_URI_PATTERN.match(value)
+    try:
+        data = base64.b64decode(value[match.end():], validate=True)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid base64 image"
+        )
+    if len(data) > MEDIA_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="Image too large"
+        )
+    verify_image(data)
+    digest = store_blob(data)
+    stored.append(digest)
+    return MEDIA_URL_PREFIX + digest
+
+def extract_media(value, stored: List[str]):
+    # Recursively swap every data-URI image for its /api/media/{sha256} reference
+    if isinstance(value, str):
+        return store_data_uri(value, stored) if DATA_URI_PATTERN.match(value) else value
+    if isinstance(value, dict):
+        return {key: extract_media(item, stored) for key, item in value.items()}
+    if isinstance(value, list):
+        return [extract_media(item, stored) for item in value]
+    return value
+
+async def extract_inline_media(data):
+    # Decoding and disk writes are blocking, so run them off the event loop
+    stored = []
+    data = await asyncio.to_thread(extract_media, data, stored)
+    schedule_variants(set(stored))
+    return data
+
+# ========================
+# Equipment Availability
+# ========================
+
+# Bookings in these states still hold their equipment for the booked interval
+RELEASED_BOOKING_STATUSES = ["cancelled"]
+
+def parse_booking_time(value, field: str, end: bool = False) -> datetime:
+    # Accepts ISO datetimes or plain dates; a plain end date covers that whole day
+    try:
+        if isinstance(value, datetime):
+            return value
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid {field}"
+        )
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if end and len(str(value)) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def booking_interval(data: dict):
+    start_at = parse_booking_time(data.get("startDate"), "startDate")
+    end_at = parse_booking_time(data.get("endDate"), "endDate", end=True)
+    if end_at <= start_at:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="endDate must be after startDate"
+        )
+    return start_at, end_at
 
-class SendOtpRequest(BaseModel):
-    identifier: str
-    type: str  # 'email' or 'phone'
+# Sorted half-open [start, end) intervals; overlap queries are a bisect plus a short scan
+class IntervalIndex:
+    def __init__(self, intervals: List[tuple]):
+        self.intervals = sorted(intervals)
+        self.starts = [interval[0] for interval in self.intervals]
+        self.max_length = max((end - start for start, end, _ in self.intervals), default=timedelta(0))
 
-class SendSignupOtpRequest(BaseModel):
-    email: EmailStr
-    phone: str
+    def overlapping(self, start: datetime, end: datetime) -> List[tuple]:
+        # Nothing starting earlier than start - max_length can still reach past start
+        low = bisect.bisect_left(self.starts, start - self.max_length)
+        high = bisect.bisect_left(self.starts, end)
+        return [interval for interval in self.intervals[low:high] if interval[1] > start]
 
-class InitialProfileRequest(BaseModel):
-    userId: str
-    profileType: List[str]
-    freelancerServices: Optional[List[str]] = []
-    businessServices: Optional[List[str]] = []
+async def load_interval_index(equipment_id: str) -> IntervalIndex:
+    index = availability_cache.get(equipment_id)
+    if index is None:
+        bookings = await db.bookings.find(
+            {"equipmentId": equipment_id, "status": {"$nin": RELEASED_BOOKING_STATUSES}},
+            {"_id": 0, "id": 1, "startAt": 1, "endAt": 1}
+        ).to_list(None)
+        index = IntervalIndex([
+            (booking["startAt"], booking["endAt"], booking["id"])
+            for booking in bookings if booking.get("startAt") and booking.get("endAt")
+        ])
+        availability_cache.set(equipment_id, index)
+    return index
+
+def booking_conflict():
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Equipment is already booked for these dates"
+    )
+
+async def held_by_another(equipment_id: str, start_at: datetime, end_at: datetime, booking_oid) -> bool:
+    return await db.bookings.find_one({
+        "equipmentId": equipment_id,
+        "status": {"$nin": RELEASED_BOOKING_STATUSES},
+        "startAt": {"$lt": end_at},
+        "endAt": {"$gt": start_at},
+        "_id": {"$ne": booking_oid}
+    }, {"_id": 1}) is not None
+
+async def reserve_equipment(booking: dict):
+    # Insert, then look for any other booking holding an overlapping interval and back
+    # out on a match. Two racing requests may both get 409, but never both succeed.
+    equipment_id = booking["equipmentId"]
+    cached = availability_cache.get(equipment_id)
+    if cached is not None and cached.overlapping(booking["startAt"], booking["endAt"]):
+        # The cached index may predate a cancellation on another worker; confirm from Mongo
+        availability_cache.pop(equipment_id)
+    index = await load_interval_index(equipment_id)
+    if index.overlapping(booking["startAt"], booking["endAt"]):
+        raise booking_conflict()
+
+    result = await insert_document(db.bookings, booking)
+    conflict = await held_by_another(equipment_id, booking["startAt"], booking["endAt"], result.inserted_id)
+    availability_cache.pop(equipment_id)
+    if conflict:
+        await db.bookings.delete_one({"_id": result.inserted_id})
+        mark_changed("bookings")
+        raise booking_conflict()
 
 # ========================
-# Helper Functions
+# Auth Dependency
 # ========================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+async def authenticate(token: Optional[str]) -> dict:
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
 
-def generate_otp() -> str:
-    return "123456"  # Fixed OTP for testing
+    session = session_cache.get(token)
+    if session is not None:
+        return session
 
-def generate_token() -> str:
-    return str(uuid.uuid4())
+    session = await db.sessions.find_one(
+        {"token": token, "expiresAt": {"$gt": datetime.utcnow()}},
+        {"_id": 0, "token": 1, "userId": 1, "expiresAt": 1}
+    )
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    remaining = (session["expiresAt"] - datetime.utcnow()).total_seconds()
+    session_cache.set(token, session, ttl_seconds=remaining)
+    return session
+
+async def get_current_session(authorization: Optional[str] = Header(None)) -> dict:
+    return await authenticate(bearer_token(authorization))
+
+async def redeem_stream_ticket(ticket: str) -> dict:
+    # Tickets are single use, so one that shows up in a log is already spent
+    session = await db.stream_tickets.find_one_and_delete(
+        {"ticket": ticket, "expiresAt": {"$gt": datetime.utcnow()}},
+        projection={"_id": 0, "userId": 1}
+    )
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired stream ticket"
+        )
+    return session
+
+async def stream_session(bearer: Optional[str], ticket: Optional[str], token: Optional[str]) -> dict:
+    if not bearer and ticket:
+        return await redeem_stream_ticket(ticket)
+    if not bearer and STREAM_QUERY_TOKEN:
+        bearer = token
+    return await authenticate(bearer)
+
+async def get_stream_session(
+    authorization: Optional[str] = Header(None),
+    ticket: Optional[str] = None,
+    token: Optional[str] = None
+) -> dict:
+    return await stream_session(bearer_token(authorization), ticket, token)
+
+def subprotocol_token(websocket: WebSocket) -> Optional[str]:
+    # new WebSocket(url, ["bearer", token]) carries the token in Sec-WebSocket-Protocol
+    protocols = websocket.scope.get("subprotocols", [])
+    if len(protocols) == 2 and protocols[0] == "bearer":
+        return protocols[1]
+    return None
+
+def ensure_self(user_id: str, session: dict):
+    # Per-user reads take the user id in the path; only its owner may read it
+    if user_id != session["userId"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Cannot access another user's data"
+        )
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
 
 # ========================
 # Auth Routes
 # ========================
 
 @api_router.post("/auth/send-signup-otp")
-async def send_signup_otp(request: SendSignupOtpRequest):
+async def send_signup_otp(request: SendSignupOtpRequest, http_request: Request):
+    # Throttle before any database work
+    await limit_otp_sends(http_request, request.email, request.phone)
+    
     # Check if user already exists
     existing_user = await db.users.find_one({
         "$or": [{"email": request.email}, {"phone": request.phone}]
-    })
+    }, {"_id": 1})
     
     if existing_user:
         raise HTTPException(
@@ -114,42 +1991,38 @@ async def send_signup_otp(request: SendSignupOtpRequest):
     # Generate OTP
     otp = generate_otp()
     
-    # Store OTP in database (expires in 10 minutes)
-    await db.otps.update_one(
-        {"identifier": request.email},
-        {"$set": {
-            "otp": otp,
-            "phone": request.phone,
-            "createdAt": datetime.utcnow()
-        }},
-        upsert=True
-    )
+    # Store OTP (expires after OTP_TTL_SECONDS)
+    await otp_store.issue(request.email, otp, phone=request.phone)
     
-    # In production, send OTP via email/SMS
-    logger.info(f"OTP for {request.email}: {otp}")
+    # Queue the email; delivery workers send it off the request path
+    await enqueue_delivery("email", request.email, "otp", {"otp": otp}, ttl_seconds=OTP_TTL_SECONDS)
     
     return {"message": "OTP sent successfully", "otp": otp}  # Remove otp in production
 
 @api_router.post("/auth/signup")
 async def signup(request: SignupRequest):
-    # Verify OTP
-    otp_record = await db.otps.find_one({"identifier": request.email})
+    # Check if passwords match (before the OTP is consumed)
+    if request.password != request.confirmPassword:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Passwords do not match"
+        )
     
-    if not otp_record or otp_record["otp"] != request.otp:
+    # Verify and consume OTP; it was issued for this email and phone pair only
+    record = await otp_store.verify(request.email, request.otp)
+    if not record:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid OTP"
         )
-    
-    # Check if passwords match
-    if request.password != request.confirmPassword:
+    if record.get("phone") != request.phone:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Passwords do not match"
+            detail="Phone number does not match the OTP request"
         )
     
     # Hash password
-    hashed_password = hash_password(request.password)
+    hashed_password = await run_password_job(hash_password, request.password)
     
     # Create user
     user = User(
@@ -160,18 +2033,26 @@ async def signup(request: SignupRequest):
         referenceId=request.referenceId
     )
     
-    await db.users.insert_one(user.dict())
-    
-    # Delete OTP
-    await db.otps.delete_one({"identifier": request.email})
+    try:
+        await db.users.insert_one(user.dict())
+    except DuplicateKeyError:
+        # The unique email/phone indexes catch a signup racing another, or a reused phone
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="User with this email or phone already exists"
+        )
+    mark_changed("users")
     
     return {"message": "User created successfully"}
 
 @api_router.post("/auth/send-otp")
-async def send_login_otp(request: SendOtpRequest):
+async def send_login_otp(request: SendOtpRequest, http_request: Request):
+    # Throttle before any database work
+    await limit_otp_sends(http_request, request.identifier)
+    
     # Find user
     query = {"email": request.identifier} if request.type == "email" else {"phone": request.identifier}
-    user = await db.users.find_one(query)
+    user = await db.users.find_one(query, {"_id": 1})
     
     if not user:
         raise HTTPException(
@@ -183,16 +2064,11 @@ async def send_login_otp(request: SendOtpRequest):
     otp = generate_otp()
     
     # Store OTP
-    await db.otps.update_one(
-        {"identifier": request.identifier},
-        {"$set": {
-            "otp": otp,
-            "createdAt": datetime.utcnow()
-        }},
-        upsert=True
-    )
+    await otp_store.issue(request.identifier, otp)
     
-    logger.info(f"OTP for {request.identifier}: {otp}")
+    # Queue the email or SMS; delivery workers send it off the request path
+    channel = "email" if request.type == "email" else "sms"
+    await enqueue_delivery(channel, request.identifier, "otp", {"otp": otp}, ttl_seconds=OTP_TTL_SECONDS)
     
     return {"message": "OTP sent successfully", "otp": otp}  # Remove otp in production
 
@@ -200,7 +2076,7 @@ async def send_login_otp(request: SendOtpRequest):
 async def login(request: LoginRequest):
     # Find user
     query = {"email": request.identifier} if request.type == "email" else {"phone": request.identifier}
-    user = await db.users.find_one(query)
+    user = await db.users.find_one(query, LOGIN_USER_PROJECTION)
     
     if not user:
         raise HTTPException(
@@ -210,33 +2086,25 @@ async def login(request: LoginRequest):
     
     # Verify credentials
     if request.password:
-        if not verify_password(request.password, user["password"]):
+        if not await run_password_job(verify_password, request.password, user["password"]):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
             )
     elif request.otp:
-        otp_record = await db.otps.find_one({"identifier": request.identifier})
-        if not otp_record or otp_record["otp"] != request.otp:
+        if not await otp_store.verify(request.identifier, request.otp):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid OTP"
             )
-        await db.otps.delete_one({"identifier": request.identifier})
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Password or OTP required"
         )
     
-    # Generate token
-    token = generate_token()
-    
-    # Update user with token
-    await db.users.update_one(
-        {"_id": user["_id"]},
-        {"$set": {"token": token}}
-    )
+    # Start a new session (revokes any previous token)
+    token = await create_session(user["id"])
     
     # Return user data
     user_data = {
@@ -251,194 +2119,1016 @@ async def login(request: LoginRequest):
     
     return {"user": user_data, "message": "Login successful"}
 
+@api_router.post("/auth/logout")
+async def logout(session: dict = Depends(get_current_session)):
+    session_cache.pop(session["token"])
+    await db.sessions.delete_one({"token": session["token"]})
+    return {"message": "Logged out successfully"}
+
+@api_router.post("/auth/logout-all")
+async def logout_all(session: dict = Depends(get_current_session)):
+    await revoke_user_sessions(session["userId"])
+    return {"message": "Logged out of all devices successfully"}
+
 # ========================
 # Profile Routes
 # ========================
 
 @api_router.post("/profile/initial-selection")
-async def save_initial_profile(request: InitialProfileRequest):
+async def save_initial_profile(request: InitialProfileRequest, session: dict = Depends(get_current_session)):
+    user_id = session["userId"]
+    if request.userId != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Cannot modify another user's profile"
+        )
+
     # Update user profile
     await db.users.update_one(
-        {"id": request.userId},
+        {"id": user_id},
         {"$set": {
             "userType": request.profileType
         }}
     )
+    mark_changed("users")
     
-    # Create profile document
-    profile = {
-        "userId": request.userId,
-        "profileType": request.profileType,
-        "freelancerServices": request.freelancerServices,
-        "businessServices": request.businessServices,
-        "createdAt": datetime.utcnow()
-    }
-    
-    await db.profiles.insert_one(profile)
+    # Create or update the user's single profile document
+    now = datetime.utcnow()
+    await db.profiles.update_one(
+        {"userId": user_id},
+        {
+            "$set": {
+                "profileType": request.profileType,
+                "freelancerServices": request.freelancerServices,
+                "businessServices": request.businessServices,
+                "updatedAt": now
+            },
+            "$setOnInsert": {"createdAt": now},
+            "$inc": {"version": 1}
+        },
+        upsert=True
+    )
+    mark_changed("profiles")
     
     return {"message": "Profile saved successfully"}
 
 @api_router.get("/profile/{user_id}")
-async def get_profile(user_id: str):
-    profile = await db.profiles.find_one({"userId": user_id})
+async def get_profile(user_id: str, fields: Optional[str] = None):
+    profile = await db.profiles.find_one({"userId": user_id}, read_projection("profile", fields))
     if not profile:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Profile not found"
         )
-    # Remove MongoDB ObjectId to make it JSON serializable
-    if "_id" in profile:
-        del profile["_id"]
-    return profile
+    return MongoJSONResponse(profile)
+
+# ========================
+# Marketplace Search
+# ========================
+
+PRICE_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+background_tasks = set()
+
+# Bump when search_fields changes shape so the startup backfill recomputes old summaries
+SEARCH_FIELDS_VERSION = 2
+
+# Historic and colloquial names mapped onto the keys of cities.json
+CITY_ALIASES = {
+    "bangalore": "bengaluru",
+    "bombay": "mumbai",
+    "new delhi": "delhi",
+    "gurgaon": "gurugram",
+    "calcutta": "kolkata",
+    "madras": "chennai",
+    "trivandrum": "thiruvananthapuram",
+    "mysore": "mysuru",
+    "vizag": "visakhapatnam",
+    "cochin": "kochi",
+    "mangalore": "mangaluru",
+    "panaji": "goa",
+}
+
+def collect_prices(value, prices: List[float], in_pricing: bool = False):
+    # Any number under a "pricing" key counts, whatever the service's pricing shape
+    if isinstance(value, dict):
+        for key, item in value.items():
+            collect_prices(item, prices, in_pricing or key == "pricing")
+    elif isinstance(value, list):
+        for item in value:
+            collect_prices(item, prices, in_pricing)
+    elif in_pricing and isinstance(value, (int, float)) and not isinstance(value, bool):
+        prices.append(float(value))
+    elif in_pricing and isinstance(value, str):
+        match = PRICE_PATTERN.search(value.replace(",", ""))
+        if match:
+            prices.append(float(match.group()))
+
+def normalize_city(value) -> Optional[str]:
+    # "Mumbai, Maharashtra" and "mumbai" both index as "mumbai"
+    if not isinstance(value, str) or not value.strip():
+        return None
+    city = value.split(",")[0].strip().lower()
+    return CITY_ALIASES.get(city, city)
+
+def geo_point(profile: dict, city: Optional[str]) -> Optional[dict]:
+    # Explicit coordinates win; otherwise geocode the city from the bundled table
+    lat, lng = profile.get("lat"), profile.get("lng")
+    if isinstance(lat, (int, float)) and isinstance(lng, (int, float)) and -90 <= lat <= 90 and -180 <= lng <= 180:
+        return {"type": "Point", "coordinates": [float(lng), float(lat)]}
+    if city in CITY_COORDINATES:
+        lat, lng = CITY_COORDINATES[city]
+        return {"type": "Point", "coordinates": [lng, lat]}
+    return None
+
+def search_fields(profile: dict, owner_name: Optional[str]) -> dict:
+    # Denormalized, index-friendly summary stored on each service profile as "search"
+    equipment = [item for item in profile.get("equipment") or [] if isinstance(item, dict)]
+    prices = []
+    collect_prices(profile, prices)
+    city = normalize_city(profile.get("city") or profile.get("location"))
+    return {
+        "version": SEARCH_FIELDS_VERSION,
+        "name": owner_name,
+        "city": city,
+        "geo": geo_point(profile, city),
+        "minPrice": min(prices) if prices else None,
+        "maxPrice": max(prices) if prices else None,
+        "categories": sorted({str(item["category"]).lower() for item in equipment if item.get("category")}),
+        "brands": sorted({str(item["brand"]) for item in equipment if item.get("brand")}),
+        "models": sorted({str(item["model"]) for item in equipment if item.get("model")}),
+    }
+
+async def owner_name(user_id: str) -> Optional[str]:
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "fullName": 1})
+    return user.get("fullName") if user else None
+
+async def build_search_fields(profile: dict) -> dict:
+    return search_fields(profile, await owner_name(profile["userId"]))
+
+async def backfill_search_fields():
+    # Profiles saved before the current summary version get recomputed once, in batches
+    names = {}
+    updates = []
+    try:
+        cursor = db.service_profiles.find(
+            {"search.version": {"$ne": SEARCH_FIELDS_VERSION}}
+        ).batch_size(EXPORT_BATCH_SIZE)
+        async for profile in cursor:
+            user_id = profile.get("userId")
+            if user_id not in names:
+                names[user_id] = await owner_name(user_id) if user_id else None
+            updates.append(UpdateOne({"_id": profile["_id"]}, {"$set": {"search": search_fields(profile, names[user_id])}}))
+            if len(updates) >= EXPORT_BATCH_SIZE:
+                await db.service_profiles.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            await db.service_profiles.bulk_write(updates, ordered=False)
+    except Exception as e:
+        logger.error(f"Search field backfill failed: {e}")
+
+def search_result(doc: dict) -> dict:
+    summary = doc.pop("search", None) or {}
+    return {
+        **doc,
+        "name": summary.get("name"),
+        "city": summary.get("city"),
+        "minPrice": summary.get("minPrice"),
+        "maxPrice": summary.get("maxPrice"),
+        "categories": summary.get("categories", [])
+    }
+
+@api_router.get("/search")
+async def search_profiles(
+    q: Optional[str] = Query(None, max_length=100),
+    serviceType: Optional[str] = None,
+    city: Optional[str] = None,
+    minPrice: Optional[float] = Query(None, ge=0),
+    maxPrice: Optional[float] = Query(None, ge=0),
+    category: Optional[str] = None,
+    sort: Literal["relevance", "price_asc", "price_desc"] = "relevance",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET)
+):
+    query = {}
+    if q and q.strip():
+        query["$text"] = {"$search": q}
+    if serviceType:
+        query["serviceType"] = serviceType
+    if city:
+        query["search.city"] = normalize_city(city)
+    if category:
+        query["search.categories"] = category.lower()
+    # Price filters apply to the profile's starting price
+    price_range = {}
+    if minPrice is not None:
+        price_range["$gte"] = minPrice
+    if maxPrice is not None:
+        price_range["$lte"] = maxPrice
+    if price_range:
+        query["search.minPrice"] = price_range
+
+    projection = {"_id": 0, "userId": 1, "serviceType": 1, "yearsOfExperience": 1, "styles": 1, "search": 1}
+    if "$text" in query:
+        projection["score"] = {"$meta": "textScore"}
+
+    if sort == "price_asc":
+        sort_spec = [("search.minPrice", ASCENDING), ("_id", ASCENDING)]
+    elif sort == "price_desc":
+        sort_spec = [("search.minPrice", DESCENDING), ("_id", DESCENDING)]
+    elif "$text" in query:
+        sort_spec = [("score", {"$meta": "textScore"})]
+    else:
+        sort_spec = [("createdAt", DESCENDING), ("_id", DESCENDING)]
+
+    docs = await db.service_profiles.find(query, projection).sort(sort_spec).skip(offset).limit(limit).to_list(limit)
+    items = [search_result(doc) for doc in docs]
+    next_offset = offset + limit if len(items) == limit and offset + limit <= SEARCH_MAX_OFFSET else None
+    return MongoJSONResponse({"items": items, "next_offset": next_offset})
+
+@api_router.get("/search/nearby")
+async def search_nearby(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius: float = Query(NEARBY_DEFAULT_RADIUS_KM, gt=0, le=NEARBY_MAX_RADIUS_KM),
+    serviceType: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET)
+):
+    # $geoNear walks the 2dsphere index outwards, so results arrive already distance-sorted
+    geo_near = {
+        "near": {"type": "Point", "coordinates": [lng, lat]},
+        "distanceField": "distance",
+        "maxDistance": radius * 1000,
+        "key": "search.geo",
+        "spherical": True
+    }
+    if serviceType:
+        geo_near["query"] = {"serviceType": serviceType}
+
+    docs = await db.service_profiles.aggregate([
+        {"$geoNear": geo_near},
+        {"$skip": offset},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "userId": 1, "serviceType": 1, "yearsOfExperience": 1, "styles": 1,
+                      "search": 1, "distance": 1}}
+    ]).to_list(limit)
+
+    items = []
+    for doc in docs:
+        distance = doc.pop("distance")
+        items.append({**search_result(doc), "distanceKm": round(distance / 1000, 2)})
+    next_offset = offset + limit if len(items) == limit and offset + limit <= SEARCH_MAX_OFFSET else None
+    return MongoJSONResponse({"items": items, "next_offset": next_offset})
 
 # ========================
 # Advanced Profile Routes
 # ========================
 
+async def save_service_profile(service_type: str, request: ServiceProfileRequest, session: dict) -> int:
+    # One document per (userId, serviceType). Only the fields the client sent and that differ
+    # from the stored profile are written, as a compare-and-set on its version. Fields sent
+    # as null are removed. Returns the profile's version after the save.
+    dumped = request.model_dump(exclude_none=True)
+    data = await extract_inline_media({name: dumped.get(name) for name in request.model_fields_set - {"version"}})
+    key = {"userId": session["userId"], "serviceType": service_type}
+
+    for _ in range(PROFILE_WRITE_RETRIES):
+        current = await db.service_profiles.find_one(key) or {}
+        version = current.get("version")
+        if request.version is not None and request.version != (version or 0):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Profile has changed since it was loaded"
+            )
+
+        changes = {name: value for name, value in data.items() if current.get(name) != value}
+        removed = [name for name, value in changes.items() if value is None and name in current]
+        changes = {name: value for name, value in changes.items() if value is not None}
+        merged = {**current, **key, **changes}
+        for name in removed:
+            del merged[name]
+        search = await build_search_fields(merged)
+        if search != current.get("search"):
+            changes["search"] = search
+
+        now = datetime.utcnow()
+        if not current:
+            try:
+                await db.service_profiles.insert_one({**key, **changes, "version": 1, "createdAt": now})
+                return 1
+            except DuplicateKeyError:
+                continue  # a concurrent save created it first; diff against that one
+        if not changes and not removed:
+            return version or 0
+
+        update = {"$set": {**changes, "updatedAt": now}, "$inc": {"version": 1}}
+        if removed:
+            update["$unset"] = {name: "" for name in removed}
+        result = await db.service_profiles.update_one({**key, "version": version}, update)
+        if result.modified_count:
+            return (version or 0) + 1
+
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Profile is being updated concurrently, try again"
+    )
+
 @api_router.post("/profile/photographer")
-async def save_photographer_profile(data: dict):
-    photographer_profile = {
-        **data,
-        "serviceType": "photographer",
-        "createdAt": datetime.utcnow()
-    }
-    await db.service_profiles.insert_one(photographer_profile)
-    return {"message": "Photographer profile saved successfully"}
+async def save_photographer_profile(request: PhotographerProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("photographer", request, session)
+    return {"message": "Photographer profile saved successfully", "version": version}
 
 @api_router.post("/profile/camera-rental")
-async def save_camera_rental_profile(data: dict):
-    camera_rental_profile = {
-        **data,
-        "serviceType": "camera_rental",
-        "createdAt": datetime.utcnow()
-    }
-    await db.service_profiles.insert_one(camera_rental_profile)
-    return {"message": "Camera rental profile saved successfully"}
+async def save_camera_rental_profile(request: CameraRentalProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("camera_rental", request, session)
+    return {"message": "Camera rental profile saved successfully", "version": version}
 
 @api_router.post("/profile/album-designer")
-async def save_album_designer_profile(data: dict):
-    profile = {**data, "serviceType": "album_designer", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "Album Designer profile saved successfully"}
+async def save_album_designer_profile(request: AlbumDesignerProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("album_designer", request, session)
+    return {"message": "Album Designer profile saved successfully", "version": version}
 
 @api_router.post("/profile/video-editor")
-async def save_video_editor_profile(data: dict):
-    profile = {**data, "serviceType": "video_editor", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "Video Editor profile saved successfully"}
+async def save_video_editor_profile(request: VideoEditorProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("video_editor", request, session)
+    return {"message": "Video Editor profile saved successfully", "version": version}
 
 @api_router.post("/profile/web-live-services")
-async def save_web_live_services_profile(data: dict):
-    profile = {**data, "serviceType": "web_live_services", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "Web Live Services profile saved successfully"}
+async def save_web_live_services_profile(request: WebLiveServicesProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("web_live_services", request, session)
+    return {"message": "Web Live Services profile saved successfully", "version": version}
 
 @api_router.post("/profile/led-wall")
-async def save_led_wall_profile(data: dict):
-    profile = {**data, "serviceType": "led_wall", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "LED Wall profile saved successfully"}
+async def save_led_wall_profile(request: LedWallProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("led_wall", request, session)
+    return {"message": "LED Wall profile saved successfully", "version": version}
 
 @api_router.post("/profile/fly-cam")
-async def save_fly_cam_profile(data: dict):
-    profile = {**data, "serviceType": "fly_cam", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "Fly Cam profile saved successfully"}
+async def save_fly_cam_profile(request: FlyCamProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("fly_cam", request, session)
+    return {"message": "Fly Cam profile saved successfully", "version": version}
 
 @api_router.post("/profile/photography-firm")
-async def save_photography_firm_profile(data: dict):
-    profile = {**data, "serviceType": "photography_firm", "createdAt": datetime.utcnow()}
-    await db.service_profiles.insert_one(profile)
-    return {"message": "Photography Firm profile saved successfully"}
+async def save_photography_firm_profile(request: PhotographyFirmProfileRequest, session: dict = Depends(get_current_session)):
+    version = await save_service_profile("photography_firm", request, session)
+    return {"message": "Photography Firm profile saved successfully", "version": version}
+
+# ========================
+# Media Routes
+# ========================
+
+def pick_variant(size: Optional[str], width: Optional[int]) -> Optional[str]:
+    if size:
+        return size
+    if width:
+        # Smallest variant whose longest edge still covers the requested width
+        for variant, max_edge in MEDIA_VARIANTS.items():
+            if max_edge is None or max_edge >= width:
+                return variant
+    return None
+
+@api_router.get("/media/{digest}")
+async def get_media(
+    digest: str,
+    size: Optional[str] = Query(None, pattern="^(thumb|medium|full)$"),
+    w: Optional[int] = Query(None, ge=1),
+    format: Optional[str] = Query(None, pattern="^(webp|jpeg)$"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    if not MEDIA_HASH_PATTERN.match(digest) or not media_path(digest).exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Media not found"
+        )
+
+    # Serve a resized variant when asked and already generated, else the original upload
+    path = media_path(digest)
+    etag = f'"{digest}"'
+    cache_control = "public, max-age=31536000, immutable"
+    vary = None
+    variant = pick_variant(size, w)
+    if variant:
+        fmt = format
+        if not fmt:
+            fmt = "webp" if accept and "image/webp" in accept else "jpeg"
+            vary = "Accept"
+        variant_path = media_variant_path(digest, variant, fmt)
+        if variant_path.exists():
+            path = variant_path
+            etag = f'"{digest}.{variant}.{fmt}"'
+        else:
+            # Still being generated; let clients come back for the real variant soon
+            cache_control = "public, max-age=60"
+
+    # Content-addressed blobs never change, so the hash is a strong validator
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "X-Content-Type-Options": "nosniff"
+    }
+    if vary:
+        headers["Vary"] = vary
+    if if_none_match and etag in if_none_match:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    with open(path, "rb") as f:
+        head = f.read(12)
+    media_type = "application/octet-stream"
+    for signature, content_type in MEDIA_SIGNATURES:
+        if head.startswith(signature):
+            media_type = content_type
+            break
+    return FileResponse(path, media_type=media_type, headers=headers)
 
 # ========================
 # Inventory Management Routes
 # ========================
 
-@api_router.get("/inventory/status")
-async def get_inventory_status():
-    # Mock data for now - in production, fetch from database
-    inventory = [
-        {
-            "id": "1",
-            "equipmentName": "Canon EOS R5",
-            "category": "Camera",
-            "status": "in"
-        },
-        {
-            "id": "2",
-            "equipmentName": "Sony A7 IV",
-            "category": "Camera",
-            "status": "out",
-            "rentalInfo": {
-                "seekerName": "John Doe",
-                "phone": "+91 9876543210",
-                "location": "Mumbai, Maharashtra",
-                "startDate": "2024-01-10",
-                "endDate": "2024-01-12"
-            }
-        },
-        {
-            "id": "3",
-            "equipmentName": "DJI Ronin RS3",
-            "category": "Gimbal",
-            "status": "maintenance"
-        }
+# One round-trip for the whole dashboard: each item joins its in-progress booking
+# (bookings.equipmentId_status index) and that booking's seeker (users.id_unique)
+def inventory_status_pipeline(owner_id: str) -> List[dict]:
+    return [
+        {"$match": {"ownerId": owner_id}},
+        {"$sort": {"createdAt": 1}},
+        {"$lookup": {
+            "from": "bookings",
+            "localField": "id",
+            "foreignField": "equipmentId",
+            "pipeline": [
+                {"$match": {"status": "in-progress"}},
+                {"$sort": {"createdAt": -1}},
+                {"$limit": 1},
+                {"$lookup": {
+                    "from": "users",
+                    "localField": "userId",
+                    "foreignField": "id",
+                    "pipeline": [{"$project": {"_id": 0, "fullName": 1, "phone": 1}}],
+                    "as": "seeker"
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "seekerName": {"$first": "$seeker.fullName"},
+                    "phone": {"$first": "$seeker.phone"},
+                    "location": 1,
+                    "startDate": 1,
+                    "endDate": 1
+                }}
+            ],
+            "as": "activeRental"
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "equipmentName": {"$ifNull": [
+                "$equipmentName",
+                {"$trim": {"input": {"$concat": [
+                    {"$ifNull": ["$brand", ""]}, " ", {"$ifNull": ["$model", ""]}
+                ]}}}
+            ]},
+            "category": 1,
+            "status": {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$status", "maintenance"]}, "then": "maintenance"},
+                    {"case": {"$gt": [{"$size": "$activeRental"}, 0]}, "then": "out"},
+                    {"case": {"$eq": ["$status", "out"]}, "then": "out"}
+                ],
+                "default": "in"
+            }},
+            "rentalInfo": {"$first": "$activeRental"}
+        }}
     ]
-    return inventory
+
+def invalidate_inventory_status(owner_id: Optional[str]):
+    # Other workers converge within INVENTORY_CACHE_TTL_SECONDS
+    if owner_id:
+        inventory_status_cache.pop(owner_id)
+
+@api_router.get("/inventory/status")
+async def get_inventory_status(session: dict = Depends(get_current_session)):
+    owner_id = session["userId"]
+    inventory = inventory_status_cache.get(owner_id)
+    if inventory is None:
+        inventory = await db.equipment.aggregate(inventory_status_pipeline(owner_id)).to_list(None)
+        inventory_status_cache.set(owner_id, inventory)
+    return MongoJSONResponse(inventory)
+
+@api_router.get("/inventory/equipment/{equipment_id}/availability")
+async def get_equipment_availability(
+    equipment_id: str,
+    from_: str = Query(..., alias="from"),
+    to: str = Query(...)
+):
+    start_at = parse_booking_time(from_, "from")
+    end_at = parse_booking_time(to, "to", end=True)
+    if end_at <= start_at:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="to must be after from"
+        )
+    if availability_cache.get(equipment_id) is None:
+        if not await db.equipment.find_one({"id": equipment_id}, {"_id": 1}):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Equipment not found"
+            )
+
+    index = await load_interval_index(equipment_id)
+    booked = index.overlapping(start_at, end_at)
+    return {
+        "equipmentId": equipment_id,
+        "from": start_at,
+        "to": end_at,
+        "available": not booked,
+        "booked": [
+            {"bookingId": booking_id, "startAt": start, "endAt": end}
+            for start, end, booking_id in booked
+        ]
+    }
+
+@api_router.patch("/inventory/equipment/{equipment_id}/status")
+async def update_equipment_status(
+    equipment_id: str,
+    request: EquipmentStatusUpdate,
+    session: dict = Depends(get_current_session)
+):
+    result = await db.equipment.update_one(
+        {"id": equipment_id, "ownerId": session["userId"]},
+        {"$set": {"status": request.status, "updatedAt": datetime.utcnow()}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Equipment not found"
+        )
+    mark_changed("equipment")
+    invalidate_inventory_status(session["userId"])
+    return {"message": "Equipment status updated successfully"}
 
 @api_router.post("/inventory/equipment")
-async def add_equipment(data: dict):
+async def add_equipment(request: EquipmentItem, session: dict = Depends(get_current_session)):
+    data = await extract_inline_media(request.model_dump(exclude_none=True))
     equipment = {
         **data,
         "id": str(uuid.uuid4()),
+        "ownerId": session["userId"],
         "createdAt": datetime.utcnow()
     }
-    await db.equipment.insert_one(equipment)
-    return {"message": "Equipment added successfully", "equipment": equipment}
+    await insert_document(db.equipment, equipment)
+    mark_changed("equipment")
+    invalidate_inventory_status(session["userId"])
+    return MongoJSONResponse({"message": "Equipment added successfully", "equipment": equipment})
+
+# ========================
+# Bulk Equipment Import
+# ========================
+
+def decode_line(line: bytes):
+    try:
+        return line.decode('utf-8').rstrip("\r")
+    except UnicodeDecodeError as e:
+        return e
+
+async def request_lines(request: Request):
+    # Yield decoded lines as the body streams in, without buffering the whole upload.
+    # Lines are split before decoding (a newline byte never occurs inside a UTF-8
+    # sequence), so invalid bytes are yielded as that line's error.
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield decode_line(line)
+    if buffer:
+        yield decode_line(buffer)
+
+async def ndjson_rows(request: Request):
+    # Unparseable lines are yielded as their error so the rest of the stream still imports
+    async for line in request_lines(request):
+        if isinstance(line, ValueError):
+            yield line
+        elif line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield e
+
+def nest_csv_row(header: List[str], values: List[str]) -> dict:
+    # Dotted headers such as pricing.sixHours become nested objects; images are "|" separated
+    row = {}
+    for key, value in zip(header, values):
+        if value == "":
+            continue
+        if key == "images":
+            value = value.split("|")
+        target = row
+        *parents, leaf = key.split(".")
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[leaf] = value
+    return row
+
+async def csv_rows(request: Request):
+    header = None
+    pending = ""
+    async for line in request_lines(request):
+        if isinstance(line, ValueError):
+            if header is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="CSV header is not valid UTF-8"
+                )
+            # Drop any partial record along with the undecodable line it was continuing
+            pending = ""
+            yield line
+            continue
+        # An odd number of quotes means a quoted field continues on the next line
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue
+        record, pending = pending, ""
+        if not record.strip():
+            continue
+        values = next(csv.reader([record]))
+        if header is None:
+            header = [name.strip() for name in values]
+        else:
+            yield nest_csv_row(header, values)
+
+async def json_array_rows(request: Request):
+    try:
+        rows = await request.json()
+    except ValueError:
+        rows = None
+    if not isinstance(rows, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Expected a JSON array of equipment"
+        )
+    for row in rows:
+        yield row
+
+def extract_rows_media(docs: List[dict], stored: List[str]) -> list:
+    # Row by row, so a bad or oversized image fails its own row rather than the import
+    extracted = []
+    for doc in docs:
+        try:
+            extracted.append(extract_media(doc, stored))
+        except HTTPException as e:
+            extracted.append(e.detail)
+        except ValueError as e:
+            extracted.append(str(e))
+    return extracted
+
+async def insert_equipment_chunk(chunk: List[dict], chunk_rows: List[int], errors: List[dict]) -> int:
+    stored = []
+    extracted = await asyncio.to_thread(extract_rows_media, chunk, stored)
+    schedule_variants(set(stored))
+    docs, rows = [], []
+    for row, doc in zip(chunk_rows, extracted):
+        if isinstance(doc, str):
+            errors.append({"row": row, "errors": [{"field": None, "message": doc}]})
+        else:
+            docs.append(doc)
+            rows.append(row)
+    if not docs:
+        return 0
+
+    try:
+        result = await db.equipment.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            errors.append({
+                "row": rows[write_error["index"]],
+                "errors": [{"field": None, "message": write_error.get("errmsg", "Write failed")}]
+            })
+        return e.details.get("nInserted", 0)
+
+@api_router.post("/inventory/equipment/bulk")
+async def bulk_add_equipment(request: Request, session: dict = Depends(get_current_session)):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == "application/x-ndjson":
+        rows = ndjson_rows(request)
+    elif content_type == "text/csv":
+        rows = csv_rows(request)
+    else:
+        rows = json_array_rows(request)
+
+    inserted = 0
+    total = 0
+    errors = []
+    chunk, chunk_rows = [], []
+    now = datetime.utcnow()
+    async for row in rows:
+        total += 1
+        if isinstance(row, ValueError):
+            errors.append({"row": total, "errors": [{"field": None, "message": f"Unparseable row: {row}"}]})
+            continue
+        try:
+            item = EquipmentItem.model_validate(row)
+        except ValidationError as e:
+            errors.append({
+                "row": total,
+                "errors": [
+                    {"field": ".".join(str(part) for part in err["loc"]), "message": err["msg"]}
+                    for err in e.errors()
+                ]
+            })
+            continue
+        chunk.append({
+            **item.model_dump(exclude_none=True),
+            "id": str(uuid.uuid4()),
+            "ownerId": session["userId"],
+            "createdAt": now
+        })
+        chunk_rows.append(total)
+        if len(chunk) >= BULK_INSERT_CHUNK_SIZE:
+            inserted += await insert_equipment_chunk(chunk, chunk_rows, errors)
+            chunk, chunk_rows = [], []
+
+    if chunk:
+        inserted += await insert_equipment_chunk(chunk, chunk_rows, errors)
+    if inserted:
+        mark_changed("equipment")
+        invalidate_inventory_status(session["userId"])
+
+    return {
+        "message": "Bulk import finished",
+        "received": total,
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": sorted(errors, key=lambda error: error["row"])
+    }
+
+@api_router.get("/inventory/equipment/export")
+async def export_equipment(session: dict = Depends(get_current_session)):
+    # The caller's own inventory only
+    return ndjson_export(db.equipment, {"ownerId": session["userId"]})
 
 @api_router.get("/inventory/equipment")
-async def get_equipment_list():
-    equipment = await db.equipment.find().to_list(1000)
-    return equipment
+async def get_equipment_list(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    session: dict = Depends(get_current_session)
+):
+    # The caller's own inventory only, like the export
+    return MongoJSONResponse(await paginate(
+        db.equipment, {"ownerId": session["userId"]}, cursor, limit, read_fields("equipment", fields)
+    ))
 
 # ========================
 # Booking Routes
 # ========================
 
 @api_router.post("/bookings")
-async def create_booking(data: dict):
+async def create_booking(request: BookingRequest, session: dict = Depends(get_current_session)):
+    data = request.model_dump(exclude_none=True)
     booking = {
         **data,
         "id": str(uuid.uuid4()),
+        "userId": session["userId"],
         "createdAt": datetime.utcnow(),
         "status": "pending"
     }
-    await db.bookings.insert_one(booking)
-    return {"message": "Booking created successfully", "booking": booking}
+    # Denormalize the equipment owner so status changes know whose inventory cache to drop
+    if data.get("equipmentId"):
+        equipment = await db.equipment.find_one({"id": data["equipmentId"]}, {"_id": 0, "ownerId": 1})
+        if not equipment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Equipment not found"
+            )
+        booking["ownerId"] = equipment.get("ownerId")
+        booking["startAt"], booking["endAt"] = booking_interval(data)
+        await reserve_equipment(booking)
+    else:
+        await insert_document(db.bookings, booking)
+    mark_changed("bookings")
+    invalidate_inventory_status(booking.get("ownerId"))
+    if booking.get("ownerId") and booking["ownerId"] != session["userId"]:
+        await create_notification(
+            booking["ownerId"], "booking", "New Booking Request",
+            "You have a new booking request for your equipment"
+        )
+    return MongoJSONResponse({"message": "Booking created successfully", "booking": booking})
+
+@api_router.patch("/bookings/{booking_id}/status")
+async def update_booking_status(
+    booking_id: str,
+    request: BookingStatusUpdate,
+    session: dict = Depends(get_current_session)
+):
+    # Either side of the booking may move it through its lifecycle
+    booking = await db.bookings.find_one_and_update(
+        {"id": booking_id, "$or": [{"userId": session["userId"]}, {"ownerId": session["userId"]}]},
+        {"$set": {"status": request.status, "updatedAt": datetime.utcnow()}},
+        projection={"userId": 1, "ownerId": 1, "equipmentId": 1, "status": 1, "startAt": 1, "endAt": 1}
+    )
+    if not booking:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Booking not found"
+        )
+    mark_changed("bookings")
+    invalidate_inventory_status(booking.get("ownerId"))
+    if booking.get("equipmentId"):
+        availability_cache.pop(booking["equipmentId"])
+
+    # Reviving a released booking takes its interval back, so it must not overlap a newer
+    # hold; same insert-then-check as reserve_equipment, undone on a match
+    reclaimed = (
+        booking.get("status") in RELEASED_BOOKING_STATUSES
+        and request.status not in RELEASED_BOOKING_STATUSES
+        and booking.get("equipmentId") and booking.get("startAt") and booking.get("endAt")
+    )
+    if reclaimed and await held_by_another(booking["equipmentId"], booking["startAt"], booking["endAt"], booking["_id"]):
+        await db.bookings.update_one(
+            {"_id": booking["_id"], "status": request.status},
+            {"$set": {"status": booking["status"]}}
+        )
+        # A read between the two updates may have cached the revived status; stamp again
+        mark_changed("bookings")
+        invalidate_inventory_status(booking.get("ownerId"))
+        availability_cache.pop(booking["equipmentId"])
+        raise booking_conflict()
+    # Tell whichever side did not make the change
+    counterpart = booking.get("ownerId") if booking.get("userId") == session["userId"] else booking.get("userId")
+    if counterpart and counterpart != session["userId"]:
+        await create_notification(
+            counterpart, "update", "Booking Updated",
+            f"A booking has been marked {request.status}"
+        )
+    return {"message": "Booking status updated successfully"}
+
+# Declared before /bookings/{user_id} so "export" is not taken as a user id
+@api_router.get("/bookings/export")
+async def export_bookings(session: dict = Depends(get_current_session)):
+    # Bookings the caller made or received on their equipment
+    user_id = session["userId"]
+    return ndjson_export(db.bookings, {"$or": [{"userId": user_id}, {"ownerId": user_id}]})
 
 @api_router.get("/bookings/{user_id}")
-async def get_user_bookings(user_id: str):
-    bookings = await db.bookings.find({"userId": user_id}).to_list(1000)
-    return bookings
+async def get_user_bookings(
+    user_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    session: dict = Depends(get_current_session)
+):
+    ensure_self(user_id, session)
+    return MongoJSONResponse(await paginate(
+        db.bookings, {"userId": user_id}, cursor, limit, read_fields("bookings", fields)
+    ))
 
 # ========================
 # Notification Routes
 # ========================
 
+@api_router.post("/notifications/stream-ticket")
+async def create_stream_ticket(session: dict = Depends(get_current_session)):
+    ticket = generate_token()
+    await db.stream_tickets.insert_one({
+        "ticket": ticket,
+        "userId": session["userId"],
+        "expiresAt": datetime.utcnow() + timedelta(seconds=STREAM_TICKET_TTL_SECONDS)
+    })
+    return {"ticket": ticket, "expiresIn": STREAM_TICKET_TTL_SECONDS}
+
+# Declared before /notifications/{user_id} so "stream" is not taken as a user id
+@api_router.get("/notifications/stream")
+async def stream_notifications(
+    session: dict = Depends(get_stream_session),
+    last_event_id: Optional[str] = Header(None),
+    lastEventId: Optional[str] = None
+):
+    # EventSource resends Last-Event-ID when it reconnects; ?lastEventId= covers a fresh page
+    resume_from = last_event_id or lastEventId
+    after = decode_cursor(resume_from) if resume_from else None
+    return StreamingResponse(
+        sse_lines(notification_events(session["userId"], after)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.websocket("/notifications/ws")
+async def notifications_socket(
+    websocket: WebSocket,
+    ticket: Optional[str] = None,
+    token: Optional[str] = None,
+    lastEventId: Optional[str] = None
+):
+    protocol_token = subprotocol_token(websocket)
+    try:
+        bearer = bearer_token(websocket.headers.get("authorization")) or protocol_token
+        session = await stream_session(bearer, ticket, token)
+        after = decode_cursor(lastEventId) if lastEventId else None
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # The browser drops the connection unless one of its offered subprotocols is echoed
+    await websocket.accept(subprotocol="bearer" if protocol_token else None)
+
+    async def push():
+        async for event in notification_events(session["userId"], after):
+            if event is None:
+                await websocket.send_text('{"type":"ping"}')
+                continue
+            event_id, notification = event
+            message = {"type": "notification", "id": event_id, "notification": notification}
+            await websocket.send_text(orjson.dumps(message, default=json_default).decode('utf-8'))
+        # The hub cut this client loose; it should reconnect with its last id
+        await websocket.close()
+
+    pusher = asyncio.create_task(push())
+    try:
+        # Incoming frames are ignored; receiving is how a disconnect gets noticed
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pusher.cancel()
+
 @api_router.get("/notifications/{user_id}")
-async def get_notifications(user_id: str):
-    notifications = await db.notifications.find({"userId": user_id}).sort("createdAt", -1).to_list(100)
-    return notifications
+async def get_notifications(
+    user_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+    session: dict = Depends(get_current_session)
+):
+    ensure_self(user_id, session)
+    return MongoJSONResponse(await paginate(
+        db.notifications, {"userId": user_id}, cursor, limit, read_fields("notifications", fields)
+    ))
+
+@api_router.get("/notifications/{user_id}/unread-count")
+async def get_unread_count(user_id: str, session: dict = Depends(get_current_session)):
+    ensure_self(user_id, session)
+    return {"userId": user_id, "unread": await unread_notifications(user_id)}
 
 @api_router.post("/notifications/mark-read")
-async def mark_notification_read(data: dict):
-    notification_id = data.get("notificationId")
-    await db.notifications.update_one(
-        {"id": notification_id},
+async def mark_notification_read(request: MarkReadRequest, session: dict = Depends(get_current_session)):
+    # Any mix of one id, a list of ids and "everything up to a timestamp", as one update_many
+    clauses = []
+    ids = request.notificationIds + ([request.notificationId] if request.notificationId else [])
+    if ids:
+        clauses.append({"id": {"$in": ids}})
+    if request.before:
+        before = request.before
+        if before.tzinfo:
+            before = before.astimezone(timezone.utc).replace(tzinfo=None)
+        clauses.append({"createdAt": {"$lte": before}})
+    if not clauses:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="notificationId, notificationIds or before is required"
+        )
+
+    result = await db.notifications.update_many(
+        {"userId": session["userId"], "read": {"$ne": True}, **(clauses[0] if len(clauses) == 1 else {"$or": clauses})},
         {"$set": {"read": True}}
     )
-    return {"message": "Notification marked as read"}
+    return {"message": "Notification marked as read", "updated": result.modified_count}
+
+# ========================
+# Account Overview
+# ========================
+
+@api_router.get("/me")
+async def get_me(session: dict = Depends(get_current_session), if_none_match: Optional[str] = Header(None)):
+    # Everything the app loads at launch, queried concurrently and returned in one response
+    user_id = session["userId"]
+    user, profile, service_profiles, bookings, notifications, unread = await asyncio.gather(
+        db.users.find_one({"id": user_id}, read_projection("user", None)),
+        db.profiles.find_one({"userId": user_id}, read_projection("profile", None)),
+        db.service_profiles.find({"userId": user_id}, {"_id": 0, "search": 0}).to_list(None),
+        paginate(db.bookings, {"userId": user_id}, None, ME_RECENT_LIMIT, read_fields("bookings", None)),
+        paginate(db.notifications, {"userId": user_id}, None, ME_RECENT_LIMIT, read_fields("notifications", None)),
+        unread_notifications(user_id)
+    )
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    body = orjson.dumps({
+        "user": user,
+        "profile": profile,
+        "serviceProfiles": service_profiles,
+        "bookings": bookings,
+        "notifications": notifications,
+        "counters": {"unreadNotifications": unread}
+    }, default=json_default)
+    # The body hash is the validator, so a change anywhere in the dashboard yields a new ETag
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and etag in if_none_match:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 # ========================
 # Test Routes
@@ -452,9 +3142,84 @@ async def root():
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow()}
 
+@api_router.get("/admin/delivery", dependencies=[Depends(require_admin)])
+async def delivery_report():
+    depth = await db.outbox.aggregate([
+        {"$match": {"status": "pending"}},
+        {"$group": {"_id": "$channel", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    latencies = sorted(delivery_latencies)
+    return {
+        "queueDepth": {doc["_id"]: doc["count"] for doc in depth},
+        **delivery_stats,
+        "latencyMs": {
+            "p50": round(latencies[len(latencies) // 2] * 1000, 1),
+            "p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 1)
+        } if latencies else None
+    }
+
+@api_router.get("/admin/response-cache", dependencies=[Depends(require_admin)])
+async def response_cache_report():
+    lookups = response_cache_stats["hits"] + response_cache_stats["misses"]
+    return {
+        "entries": len(response_cache),
+        **response_cache_stats,
+        "hitRatio": round(response_cache_stats["hits"] / lookups, 3) if lookups else None,
+        "collectionVersions": collection_versions
+    }
+
+@api_router.get("/admin/profiling", dependencies=[Depends(require_admin)])
+async def profiling_report():
+    return MongoJSONResponse({
+        **profiling_settings,
+        **profiling_stats,
+        "profileDir": str(PROFILE_DIR),
+        "recentStalls": list(recent_stalls)
+    })
+
+@api_router.patch("/admin/profiling", dependencies=[Depends(require_admin)])
+async def update_profiling(request: ProfilingSettingsUpdate):
+    profiling_settings.update(request.model_dump(exclude_none=True))
+    if profiling_settings["enabled"]:
+        start_loop_watchdog()
+    else:
+        stop_loop_watchdog()
+    return {"message": "Profiling settings updated successfully", **profiling_settings}
+
+@api_router.get("/admin/query-plans", dependencies=[Depends(require_admin)])
+async def query_plan_report():
+    report = await explain_query_shapes()
+    return {
+        "queries": report,
+        "collectionScans": [entry["query"] for entry in report if entry["collectionScan"]],
+        "errors": [entry["query"] for entry in report if "error" in entry]
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Prometheus text exposition; scraped from the pod directly, outside the /api ingress
+    lines = []
+    for metric in (http_requests, http_latency, mongo_latency, mongo_failures, password_latency, loop_lag):
+        lines.extend(metric.render())
+    lines += gauge_lines("http_requests_in_flight", "HTTP requests currently being served.", http_requests_in_flight)
+    lines += gauge_lines("event_loop_lag_last_seconds", "Lag measured by the latest event-loop probe.", event_loop_lag_last)
+    lines += gauge_lines("password_jobs_in_flight", "bcrypt jobs queued or running in the password pool.", password_jobs_in_flight)
+    lines += gauge_lines("notification_stream_connections", "Open SSE and WebSocket notification connections.", len(notification_hub))
+    lines += gauge_lines("session_cache_entries", "Sessions cached in this process.", len(session_cache))
+    lines += gauge_lines("response_cache_entries", "Responses cached in this process.", len(response_cache))
+    lines.append("# TYPE response_cache_lookups_total counter")
+    lines += [f'response_cache_lookups_total{{result="{name}"}} {value}' for name, value in response_cache_stats.items()]
+    lines.append("# TYPE delivery_messages_total counter")
+    lines += [f'delivery_messages_total{{outcome="{name}"}} {value}' for name, value in delivery_stats.items()]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(ProfilingMiddleware)
+
+app.add_middleware(ResponseCacheMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -463,6 +3228,60 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
+@app.on_event("startup")
+async def create_db_indexes():
+    await collapse_duplicate_profiles()
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def start_search_backfill():
+    task = asyncio.create_task(backfill_search_fields())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+@app.on_event("startup")
+async def start_delivery_workers():
+    global delivery_wakeup
+    delivery_wakeup = asyncio.Event()
+    for _ in range(DELIVERY_WORKERS):
+        task = asyncio.create_task(delivery_worker())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    task = asyncio.create_task(monitor_loop_lag())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+@app.on_event("startup")
+async def start_profiling():
+    if profiling_settings["enabled"]:
+        start_loop_watchdog()
+
+@app.on_event("startup")
+async def start_notification_watch():
+    if NOTIFICATION_CHANGE_STREAM:
+        task = asyncio.create_task(watch_notifications())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in list(background_tasks):
+        task.cancel()
+    stop_loop_watchdog()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_password_executor():
+    password_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_media_executor():
+    media_executor.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""
+CAMARTES Photography Ecosystem Backend Benchmarks
+Measures throughput of performance-sensitive backend paths
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import bcrypt
+import requests
+from pymongo import MongoClient
+
+# Backend URL (defaults to the local supervisor port)
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8001/api")
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+class BackendBenchmark:
+    def __init__(self):
+        self.session = requests.Session()
+        self.results = []
+
+    def log_result(self, bench_name, ops, seconds, extra=""):
+        """Log benchmark result"""
+        rate = ops / seconds if seconds else 0.0
+        result = {
+            "bench": bench_name,
+            "ops": ops,
+            "seconds": round(seconds, 3),
+            "ops_per_sec": round(rate, 1)
+        }
+        self.results.append(result)
+        print(f"⏱  {bench_name}: {ops} ops in {seconds:.3f}s → {rate:.1f} ops/s {extra}")
+
+    def log_latency(self, bench_name, samples):
+        """Log latency percentiles for a list of per-request durations (seconds)"""
+        samples = sorted(samples)
+        p50 = statistics.median(samples) * 1000
+        p95 = samples[int(len(samples) * 0.95) - 1] * 1000
+        self.results.append({"bench": bench_name, "requests": len(samples), "p50_ms": round(p50, 2), "p95_ms": round(p95, 2)})
+        print(f"⏱  {bench_name}: {len(samples)} requests → p50 {p50:.1f}ms, p95 {p95:.1f}ms")
+
+    # ========================
+    # Password hashing
+    # ========================
+
+    def bench_password_pool(self, worker_counts=(0, 1, 2, 4, 8), logins=64):
+        """Login verification throughput vs. password pool size (0 = inline on the event loop)"""
+        password = "SecurePass123!"
+        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+        async def run(workers):
+            loop = asyncio.get_running_loop()
+            lag = 0.0
+
+            # Probe task standing in for /api/health while logins are in progress
+            async def probe():
+                nonlocal lag
+                while True:
+                    started = time.perf_counter()
+                    await asyncio.sleep(0.01)
+                    lag = max(lag, time.perf_counter() - started - 0.01)
+
+            probe_task = asyncio.create_task(probe())
+            await asyncio.sleep(0)
+            started = time.perf_counter()
+            if workers == 0:
+                for _ in range(logins):
+                    verify_password(password, hashed)
+                    await asyncio.sleep(0)
+            else:
+                executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                # Warm the pool so process start-up is not measured
+                await asyncio.gather(*[
+                    loop.run_in_executor(executor, verify_password, password, hashed)
+                    for _ in range(workers)
+                ])
+                started = time.perf_counter()
+                await asyncio.gather(*[
+                    loop.run_in_executor(executor, verify_password, password, hashed)
+                    for _ in range(logins)
+                ])
+                executor.shutdown()
+            elapsed = time.perf_counter() - started
+            probe_task.cancel()
+            return elapsed, lag
+
+        print("\n=== Password Pool Throughput ===")
+        for workers in worker_counts:
+            elapsed, lag = asyncio.run(run(workers))
+            label = "inline" if workers == 0 else f"{workers} workers"
+            self.log_result(f"bcrypt verify ({label})", logins, elapsed, f"(max loop lag {lag * 1000:.0f}ms)")
+
+    def create_user(self):
+        """Sign up a throwaway user; returns (email, password) or None"""
+        stamp = str(time.time_ns())
+        email = f"bench.{stamp}@camartes.com"
+        phone = f"+9199{stamp[-8:]}"
+        password = "SecurePass123!"
+        try:
+            otp = self.session.post(
+                f"{BACKEND_URL}/auth/send-signup-otp",
+                json={"email": email, "phone": phone},
+                timeout=10
+            ).json()["otp"]
+            self.session.post(f"{BACKEND_URL}/auth/signup", json={
+                "fullName": "Bench User",
+                "phone": phone,
+                "email": email,
+                "password": password,
+                "confirmPassword": password,
+                "otp": otp
+            }, timeout=30).raise_for_status()
+        except Exception as e:
+            print(f"❌ Could not create benchmark user: {str(e)}")
+            return None
+        return email, password
+
+    def auth_headers(self):
+        """Create a user, log in and return Authorization headers (or None)"""
+        credentials = self.create_user()
+        if not credentials:
+            return None
+        email, password = credentials
+        response = self.session.post(f"{BACKEND_URL}/auth/login", json={
+            "identifier": email,
+            "password": password,
+            "type": "email"
+        }, timeout=30)
+        return {"Authorization": f"Bearer {response.json()['user']['token']}"}
+
+    def bench_http_login(self, concurrency=16, logins=128):
+        """End-to-end POST /api/auth/login throughput against a running backend"""
+        print("\n=== HTTP Login Throughput ===")
+        credentials = self.create_user()
+        if not credentials:
+            return
+        email, password = credentials
+
+        def login(_):
+            response = requests.post(f"{BACKEND_URL}/auth/login", json={
+                "identifier": email,
+                "password": password,
+                "type": "email"
+            }, timeout=60)
+            return response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            codes = list(pool.map(login, range(logins)))
+        elapsed = time.perf_counter() - started
+        shed = codes.count(503)
+        self.log_result(f"login x{concurrency} concurrent", logins, elapsed, f"({shed} shed with 503)")
+
+    # ========================
+    # Equipment import
+    # ========================
+
+    def bench_bulk_import(self, items=800):
+        """Equipment items/sec: one POST per item vs. POST /inventory/equipment/bulk"""
+        print("\n=== Equipment Import Throughput ===")
+        headers = self.auth_headers()
+        if not headers:
+            return
+        rows = [
+            {"category": "camera", "brand": "Canon", "model": f"R5 #{i}", "serviceNumber": f"SN{i:06d}"}
+            for i in range(items)
+        ]
+
+        started = time.perf_counter()
+        for row in rows:
+            self.session.post(f"{BACKEND_URL}/inventory/equipment", json=row, headers=headers, timeout=30)
+        self.log_result("single inserts", items, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        response = self.session.post(f"{BACKEND_URL}/inventory/equipment/bulk", json=rows, headers=headers, timeout=120)
+        self.log_result("bulk JSON array", items, time.perf_counter() - started, f"({response.json().get('inserted')} inserted)")
+
+        ndjson = "\n".join(json.dumps(row) for row in rows)
+        started = time.perf_counter()
+        response = self.session.post(
+            f"{BACKEND_URL}/inventory/equipment/bulk",
+            data=ndjson.encode('utf-8'),
+            headers={**headers, "Content-Type": "application/x-ndjson"},
+            timeout=120
+        )
+        self.log_result("bulk NDJSON stream", items, time.perf_counter() - started, f"({response.json().get('inserted')} inserted)")
+
+    # ========================
+    # Marketplace search
+    # ========================
+
+    def bench_search(self, profiles=500_000, queries=200):
+        """GET /api/search latency over synthetic service profiles seeded straight into Mongo"""
+        print("\n=== Marketplace Search Latency ===")
+        if "MONGO_URL" not in os.environ or "DB_NAME" not in os.environ:
+            print("❌ MONGO_URL and DB_NAME are required to seed synthetic profiles")
+            return
+        collection = MongoClient(os.environ["MONGO_URL"])[os.environ["DB_NAME"]].service_profiles
+
+        service_types = ["photographer", "camera_rental", "album_designer", "video_editor",
+                         "web_live_services", "led_wall", "fly_cam", "photography_firm"]
+        cities = ["mumbai", "delhi", "bengaluru", "chennai", "kolkata", "hyderabad", "pune", "jaipur"]
+        categories = ["camera", "lens", "lighting", "gimbal", "tripod"]
+        brands = ["Canon", "Sony", "Nikon", "Fujifilm", "DJI", "Sigma", "Godox", "Aputure"]
+        names = ["Aarav", "Vivaan", "Aditya", "Diya", "Ananya", "Ishaan", "Kavya", "Rohan"]
+        rng = random.Random(42)
+
+        # Same "search" summary layout the backend writes on every profile save
+        existing = collection.count_documents({"synthetic": True})
+        started = time.perf_counter()
+        batch = []
+        for i in range(existing, profiles):
+            price = rng.randint(5, 500) * 100
+            gear = rng.sample(brands, 2)
+            batch.append({
+                "userId": f"synthetic-{i}",
+                "serviceType": rng.choice(service_types),
+                "synthetic": True,
+                "createdAt": datetime.utcnow(),
+                "search": {
+                    "name": f"{rng.choice(names)} Studio {i}",
+                    "city": rng.choice(cities),
+                    "minPrice": float(price),
+                    "maxPrice": float(price * 3),
+                    "categories": rng.sample(categories, 2),
+                    "brands": gear,
+                    "models": [f"{brand} M{rng.randint(1, 99)}" for brand in gear]
+                }
+            })
+            if len(batch) == 10_000:
+                collection.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            collection.insert_many(batch, ordered=False)
+        self.log_result("seed synthetic profiles", profiles - existing, time.perf_counter() - started)
+
+        query_mix = [
+            lambda: {},
+            lambda: {"serviceType": rng.choice(service_types)},
+            lambda: {"q": rng.choice(brands)},
+            lambda: {"q": rng.choice(names), "serviceType": rng.choice(service_types)},
+            lambda: {"serviceType": rng.choice(service_types), "city": rng.choice(cities), "sort": "price_asc"},
+            lambda: {"city": rng.choice(cities), "minPrice": 1000, "maxPrice": 5000},
+            lambda: {"category": rng.choice(categories), "sort": "price_asc"},
+        ]
+        samples = []
+        for _ in range(queries):
+            params = rng.choice(query_mix)()
+            started = time.perf_counter()
+            self.session.get(f"{BACKEND_URL}/search", params={**params, "limit": 20}, timeout=30).raise_for_status()
+            samples.append(time.perf_counter() - started)
+        self.log_latency(f"search over {profiles} profiles", samples)
+
+        if os.environ.get("BENCH_KEEP_DATA") != "1":
+            collection.delete_many({"synthetic": True})
+
+    # ========================
+    # Payload parsing / serialization
+    # ========================
+
+    def bench_payloads(self, iterations=2000):
+        """Parse and serialize cost per request: untyped dicts + stdlib json vs. typed models + orjson"""
+        print("\n=== Payload Parse / Serialize ===")
+        # The models live in the backend module; importing it does not touch Mongo
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+        os.environ.setdefault("DB_NAME", "bench")
+        os.environ.setdefault("OTP_BACKEND", "memory")
+        os.environ.setdefault("OUTBOX_SECRET", "bench-outbox-secret")
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+        import orjson
+        from fastapi.encoders import jsonable_encoder
+        from server import CameraRentalProfileRequest, MongoJSONResponse, PhotographerProfileRequest
+
+        pricing = {"sixHours": "1500", "eightHours": "2000", "twelveHours": "2800", "twentyFourHours": "4500"}
+        payloads = {
+            "photographer": (PhotographerProfileRequest, {
+                "yearsOfExperience": 6,
+                "styles": ["Wedding", "Candid", "Portrait", "Pre-wedding"],
+                "workSamples": [f"/api/media/{i:064x}" for i in range(10)],
+                "equipment": [
+                    {"id": str(i), "type": "camera", "name": "Canon EOS R5", "model": "R5", "serviceNumber": f"SN{i:06d}"}
+                    for i in range(8)
+                ],
+                "pricing": {"sixHours": "8000", "eightHours": "10000", "twelveHours": "15000"},
+                "city": "Mumbai"
+            }),
+            "camera-rental": (CameraRentalProfileRequest, {
+                "equipment": [
+                    {"id": str(i), "category": "lens", "brand": "Sony", "model": f"FE 24-70 #{i}",
+                     "serviceNumber": f"SN{i:06d}", "pricing": pricing,
+                     "images": [f"/api/media/{j:064x}" for j in range(3)]}
+                    for i in range(40)
+                ],
+                "city": "Pune"
+            })
+        }
+
+        for name, (model, payload) in payloads.items():
+            body = json.dumps(payload).encode("utf-8")
+            started = time.perf_counter()
+            for _ in range(iterations):
+                json.loads(body)
+            self.log_result(f"{name} parse (json.loads -> dict)", iterations, time.perf_counter() - started)
+            started = time.perf_counter()
+            for _ in range(iterations):
+                model.model_validate_json(body)
+            self.log_result(f"{name} parse (model_validate_json)", iterations, time.perf_counter() - started)
+
+        # Response side: a page of equipment rendered the way JSONResponse and ORJSONResponse do
+        page = {"items": [
+            {**item, "ownerId": "owner", "createdAt": datetime.utcnow()}
+            for item in payloads["camera-rental"][1]["equipment"]
+        ] * 5, "next_cursor": "x" * 40}
+        iterations = max(iterations // 10, 1)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            json.dumps(jsonable_encoder(page), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.log_result("serialize page (jsonable_encoder + json)", iterations, time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            orjson.dumps(jsonable_encoder(page))
+        self.log_result("serialize page (jsonable_encoder + orjson)", iterations, time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            MongoJSONResponse(page)
+        self.log_result("serialize page (MongoJSONResponse)", iterations, time.perf_counter() - started)
+
+    # ========================
+    # OTP rate limiter
+    # ========================
+
+    def bench_rate_limiter(self, takes=20000, requests_sent=60):
+        """Token-bucket cost per check in-process, then 429 vs. allowed latency over HTTP"""
+        print("\n=== OTP Rate Limiter Overhead ===")
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+        os.environ.setdefault("DB_NAME", "bench")
+        os.environ.setdefault("OTP_BACKEND", "memory")
+        os.environ.setdefault("OUTBOX_SECRET", "bench-outbox-secret")
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+        import server
+
+        async def run(bucket, keys):
+            started = time.perf_counter()
+            for i in range(takes):
+                await bucket.take(f"bench:{i % keys}")
+            return time.perf_counter() - started
+
+        buckets = [("memory", server.MemoryTokenBucket(10, 60))]
+        if os.environ.get("BENCH_MONGO_LIMITER") == "1":
+            buckets.append(("mongo", server.MongoTokenBucket(10, 60)))
+        for name, bucket in buckets:
+            elapsed = asyncio.run(run(bucket, 1000))
+            self.log_result(f"{name} bucket take", takes, elapsed, f"({elapsed / takes * 1e6:.1f}µs per check)")
+
+        # Same identifier over and over: the first few are served, the rest are limited
+        allowed, limited = [], []
+        for _ in range(requests_sent):
+            started = time.perf_counter()
+            response = self.session.post(f"{BACKEND_URL}/auth/send-otp", json={
+                "identifier": "ratelimit.bench@camartes.com",
+                "type": "email"
+            }, timeout=30)
+            (limited if response.status_code == 429 else allowed).append(time.perf_counter() - started)
+        if allowed:
+            self.log_latency("send-otp past the limiter", allowed)
+        if limited:
+            self.log_latency("send-otp rejected with 429", limited)
+
+    # ========================
+    # Launch round-trips
+    # ========================
+
+    def bench_me(self, launches=50):
+        """App launch: the sequential per-screen GETs vs. one GET /api/me (and its 304 revalidation)"""
+        print("\n=== Launch Round-Trips ===")
+        credentials = self.create_user()
+        if not credentials:
+            return
+        email, password = credentials
+        user = self.session.post(f"{BACKEND_URL}/auth/login", json={
+            "identifier": email,
+            "password": password,
+            "type": "email"
+        }, timeout=30).json()["user"]
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        self.session.post(f"{BACKEND_URL}/profile/initial-selection", json={
+            "userId": user["id"],
+            "profileType": ["freelancer"],
+            "freelancerServices": ["photographer"]
+        }, headers=headers, timeout=30)
+
+        sequential = []
+        for _ in range(launches):
+            started = time.perf_counter()
+            for path in (f"profile/{user['id']}", f"bookings/{user['id']}", f"notifications/{user['id']}",
+                         f"notifications/{user['id']}/unread-count"):
+                self.session.get(f"{BACKEND_URL}/{path}", headers=headers, timeout=30)
+            sequential.append(time.perf_counter() - started)
+        self.log_latency("launch via 4 sequential GETs", sequential)
+
+        combined, revalidated = [], []
+        etag = None
+        for _ in range(launches):
+            started = time.perf_counter()
+            etag = self.session.get(f"{BACKEND_URL}/me", headers=headers, timeout=30).headers.get("ETag")
+            combined.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            response = self.session.get(f"{BACKEND_URL}/me", headers={**headers, "If-None-Match": etag}, timeout=30)
+            revalidated.append(time.perf_counter() - started)
+        self.log_latency("launch via GET /me", combined)
+        self.log_latency(f"GET /me revalidation ({response.status_code})", revalidated)
+
+    # ========================
+    # Metrics overhead
+    # ========================
+
+    def bench_metrics(self, requests_sent=20000):
+        """Per-request cost of the metrics middleware around a no-op ASGI app, plus one scrape"""
+        print("\n=== Metrics Overhead ===")
+        os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+        os.environ.setdefault("DB_NAME", "bench")
+        os.environ.setdefault("OTP_BACKEND", "memory")
+        os.environ.setdefault("OUTBOX_SECRET", "bench-outbox-secret")
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+        import server
+
+        route = next(r for r in server.app.routes if getattr(r, "path", None) == "/api/bookings/{user_id}")
+        start = {"type": "http.response.start", "status": 200, "headers": []}
+        body = {"type": "http.response.body", "body": b"{}"}
+
+        async def routed(scope, receive, send):
+            scope["route"] = route
+            await send(start)
+            await send(body)
+
+        async def noop_send(message):
+            pass
+
+        async def run(asgi_app):
+            started = time.perf_counter()
+            for i in range(requests_sent):
+                scope = {"type": "http", "method": "GET", "path": f"/api/bookings/user-{i % 100}", "root_path": ""}
+                await asgi_app(scope, None, noop_send)
+            return time.perf_counter() - started
+
+        baseline = asyncio.run(run(routed))
+        elapsed = asyncio.run(run(server.MetricsMiddleware(routed))) - baseline
+        self.log_result("metrics middleware", requests_sent, elapsed, f"({elapsed / requests_sent * 1e6:.1f}µs per request)")
+
+        timer = server.CommandTimer()
+        event = type("Event", (), {
+            "command": {"find": "bookings"}, "command_name": "find",
+            "connection_id": ("localhost", 27017), "request_id": 1, "duration_micros": 800
+        })()
+        started = time.perf_counter()
+        for _ in range(requests_sent):
+            timer.started(event)
+            timer.succeeded(event)
+        elapsed = time.perf_counter() - started
+        self.log_result("mongo command timing", requests_sent, elapsed, f"({elapsed / requests_sent * 1e6:.1f}µs per command)")
+
+        started = time.perf_counter()
+        scrape = asyncio.run(server.metrics())
+        self.log_result(f"render /metrics ({len(scrape.body)} bytes)", 1, time.perf_counter() - started)
+
+    def run_all_benchmarks(self, selected=None):
+        """Run the selected benchmarks (all by default)"""
+        print("🚀 Starting CAMARTES Backend Benchmarks")
+        print(f"Backend URL: {BACKEND_URL}")
+        print("=" * 60)
+
+        benches = {
+            "password_pool": self.bench_password_pool,
+            "http_login": self.bench_http_login,
+            "bulk_import": self.bench_bulk_import,
+            "search": self.bench_search,
+            "payloads": self.bench_payloads,
+            "rate_limiter": self.bench_rate_limiter,
+            "me": self.bench_me,
+            "metrics": self.bench_metrics
+        }
+        for name, bench in benches.items():
+            if selected and name not in selected:
+                continue
+            bench()
+
+        print("\n" + "=" * 60)
+        print(f"📊 {len(self.results)} measurements recorded")
+
+def main():
+    benchmark = BackendBenchmark()
+    benchmark.run_all_benchmarks(sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
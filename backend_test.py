@@ -342,6 +342,7 @@ class BackendTester:
             response = self.session.post(
                 f"{BACKEND_URL}/profile/initial-selection",
                 json=payload,
+                headers={"Authorization": f"Bearer {self.test_data.get('user_token', '')}"},
                 timeout=10
             )
             
@@ -374,6 +375,7 @@ class BackendTester:
             response = self.session.post(
                 f"{BACKEND_URL}/profile/initial-selection",
                 json=payload,
+                headers={"Authorization": f"Bearer {self.test_data.get('user_token', '')}"},
                 timeout=10
             )
             
@@ -406,6 +408,7 @@ class BackendTester:
             response = self.session.post(
                 f"{BACKEND_URL}/profile/initial-selection",
                 json=payload,
+                headers={"Authorization": f"Bearer {self.test_data.get('user_token', '')}"},
                 timeout=10
             )
             
@@ -0,0 +1,11 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py reads these at import time; Motor connects lazily, so no database is needed
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "camartes_test")
+os.environ.setdefault("OTP_BACKEND", "memory")
+os.environ.setdefault("OUTBOX_SECRET", "test-outbox-secret")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,91 @@
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from server import IntervalIndex, booking_interval, decode_cursor, encode_cursor, parse_booking_time
+
+DAY = datetime(2030, 1, 1)
+
+
+def days(n: int) -> datetime:
+    return DAY + timedelta(days=n)
+
+
+class TestIntervalIndex:
+    def test_empty_index_has_no_overlaps(self):
+        assert IntervalIndex([]).overlapping(days(0), days(1)) == []
+
+    def test_touching_intervals_do_not_overlap(self):
+        index = IntervalIndex([(days(1), days(3), "a")])
+        assert index.overlapping(days(3), days(5)) == []
+        assert index.overlapping(days(0), days(1)) == []
+
+    def test_partial_and_contained_overlaps(self):
+        index = IntervalIndex([(days(1), days(3), "a"), (days(5), days(6), "b")])
+        assert [booking for _, _, booking in index.overlapping(days(2), days(4))] == ["a"]
+        assert [booking for _, _, booking in index.overlapping(days(0), days(10))] == ["a", "b"]
+        assert [booking for _, _, booking in index.overlapping(days(5), days(5) + timedelta(hours=1))] == ["b"]
+
+    def test_long_interval_starting_well_before_the_query(self):
+        index = IntervalIndex([(days(0), days(30), "long"), (days(10), days(11), "short")])
+        assert [booking for _, _, booking in index.overlapping(days(20), days(21))] == ["long"]
+
+    def test_unsorted_input(self):
+        index = IntervalIndex([(days(5), days(6), "b"), (days(1), days(2), "a")])
+        assert [booking for _, _, booking in index.overlapping(days(0), days(10))] == ["a", "b"]
+
+
+class TestBookingTimes:
+    def test_plain_start_date_is_midnight(self):
+        assert parse_booking_time("2030-01-01", "startDate") == days(0)
+
+    def test_plain_end_date_covers_the_whole_day(self):
+        assert parse_booking_time("2030-01-01", "endDate", end=True) == days(1)
+
+    def test_end_datetime_is_taken_as_is(self):
+        assert parse_booking_time("2030-01-01T10:00:00", "endDate", end=True) == days(0) + timedelta(hours=10)
+
+    def test_aware_datetimes_are_stored_as_naive_utc(self):
+        assert parse_booking_time("2030-01-01T05:30:00+05:30", "startDate") == days(0)
+
+    def test_invalid_value_names_the_field(self):
+        with pytest.raises(HTTPException) as error:
+            parse_booking_time("next tuesday", "startDate")
+        assert error.value.status_code == 400
+        assert error.value.detail == "Invalid startDate"
+
+    def test_missing_value_is_invalid(self):
+        with pytest.raises(HTTPException):
+            parse_booking_time(None, "endDate", end=True)
+
+    def test_same_day_booking_spans_one_day(self):
+        assert booking_interval({"startDate": "2030-01-01", "endDate": "2030-01-01"}) == (days(0), days(1))
+
+    def test_end_before_start_is_rejected(self):
+        with pytest.raises(HTTPException) as error:
+            booking_interval({"startDate": "2030-01-02T00:00:00", "endDate": "2030-01-01T12:00:00"})
+        assert error.value.status_code == 400
+
+
+class TestCursors:
+    def test_round_trip(self):
+        doc = {"createdAt": datetime(2030, 1, 1, 12, 30, 15, 123000), "_id": ObjectId()}
+        assert decode_cursor(encode_cursor(doc)) == (doc["createdAt"], doc["_id"])
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor({"createdAt": days(0), "_id": ObjectId()})
+        assert all(char.isalnum() or char in "-_=" for char in cursor)
+
+    @pytest.mark.parametrize("cursor", [
+        "not a cursor",
+        base64.urlsafe_b64encode(b"{}").decode(),
+        base64.urlsafe_b64encode(b'{"c": "2030-01-01T00:00:00", "i": "nope"}').decode(),
+        "é",
+    ])
+    def test_malformed_cursors_are_rejected(self, cursor):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
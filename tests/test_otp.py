@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import MemoryOtpStore, MemoryTokenBucket, OTP_MAX_ATTEMPTS
+
+
+def issued_store(otp: str = "123456") -> MemoryOtpStore:
+    store = MemoryOtpStore()
+    asyncio.run(store.issue("a@b.com", otp, phone="9999999999", purpose="signup"))
+    return store
+
+
+class TestMemoryOtpStore:
+    def test_unknown_identifier(self):
+        assert asyncio.run(MemoryOtpStore().verify("nobody@b.com", "123456")) is None
+
+    def test_correct_code_returns_the_record(self):
+        record = asyncio.run(issued_store().verify("a@b.com", "123456"))
+        assert record["phone"] == "9999999999"
+        assert record["purpose"] == "signup"
+
+    def test_code_is_consumed_on_success(self):
+        store = issued_store()
+        assert asyncio.run(store.verify("a@b.com", "123456")) is not None
+        assert asyncio.run(store.verify("a@b.com", "123456")) is None
+
+    def test_wrong_codes_count_attempts(self):
+        store = issued_store()
+        for attempts in range(1, OTP_MAX_ATTEMPTS):
+            assert asyncio.run(store.verify("a@b.com", "000000")) is None
+            assert store._codes.get("a@b.com")["attempts"] == attempts
+        assert asyncio.run(store.verify("a@b.com", "123456")) is not None
+
+    def test_locked_after_max_attempts_even_with_the_right_code(self):
+        store = issued_store()
+        for _ in range(OTP_MAX_ATTEMPTS):
+            asyncio.run(store.verify("a@b.com", "000000"))
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(store.verify("a@b.com", "123456"))
+        assert error.value.status_code == 429
+
+    def test_codes_are_stored_hashed(self):
+        assert "123456" not in str(issued_store()._codes.get("a@b.com"))
+
+
+class TestMemoryTokenBucket:
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+        return now
+
+    def test_burst_then_retry_after(self, clock):
+        bucket = MemoryTokenBucket(burst=3, per_hour=60)
+        assert [asyncio.run(bucket.take("ip")) for _ in range(3)] == [0.0, 0.0, 0.0]
+        assert asyncio.run(bucket.take("ip")) == pytest.approx(60)
+
+    def test_retry_after_shrinks_as_time_passes(self, clock):
+        bucket = MemoryTokenBucket(burst=1, per_hour=60)
+        asyncio.run(bucket.take("ip"))
+        clock[0] += 45
+        assert asyncio.run(bucket.take("ip")) == pytest.approx(15)
+
+    def test_refill(self, clock):
+        bucket = MemoryTokenBucket(burst=2, per_hour=60)
+        asyncio.run(bucket.take("ip"))
+        asyncio.run(bucket.take("ip"))
+        clock[0] += 60
+        assert asyncio.run(bucket.take("ip")) == 0.0
+        assert asyncio.run(bucket.take("ip")) > 0
+
+    def test_refill_is_capped_at_burst(self, clock):
+        bucket = MemoryTokenBucket(burst=2, per_hour=60)
+        asyncio.run(bucket.take("ip"))
+        clock[0] += 3600
+        assert [asyncio.run(bucket.take("ip")) for _ in range(2)] == [0.0, 0.0]
+        assert asyncio.run(bucket.take("ip")) > 0
+
+    def test_keys_are_independent(self, clock):
+        bucket = MemoryTokenBucket(burst=1, per_hour=60)
+        asyncio.run(bucket.take("a"))
+        assert asyncio.run(bucket.take("b")) == 0.0